@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import glob
+import json
+import os
+import random
+import shlex
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from aiohttp import web, ClientSession
+
+# runs webrehook with generated configs of several sizes, sends testdata
+# payloads to it and measures delivery to in-process stub destinations.
+# Usage: python bench.py --rules 10,1000 --routes 1,10 --save results.json
+
+BENCHDIR = os.path.dirname(os.path.abspath(__file__))
+APPSTARTTIMEOUT = 30
+# seconds without new deliveries to stop waiting for them
+IDLETIMEOUT = 3
+BENCHTEMPLATE = '{"id": {{ JSON["bench_id"] }}, "project": ' + \
+                '"{{ JSON["project"]["name"] }}"}'
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return(s.getsockname()[1])
+
+def load_payloads():
+    payloads = []
+    pattern = os.path.join(BENCHDIR, 'testdata', '*.json')
+    for path in sorted(glob.glob(pattern)):
+        with open(path) as f:
+            payloads.append(json.load(f))
+    return(payloads)
+
+def write_config(confdir, rules, routes, stub_port):
+# every rule checks its own project name, only the last one matches the
+# payloads, so all rules are candidates for indexing and one is delivered
+# to all routes
+    os.makedirs(os.path.join(confdir, 'templates'))
+    with open(os.path.join(confdir, 'templates', 'bench.j2'), 'w') as f:
+        f.write(BENCHTEMPLATE)
+    with open(os.path.join(confdir, 'routes.yml'), 'w') as f:
+        for i in range(routes):
+            f.write(f'r{i}: http://127.0.0.1:{stub_port}/r{i}\n')
+    with open(os.path.join(confdir, 'rules.yml'), 'w') as f:
+        for i in range(rules):
+            project = 'bench' if i == rules - 1 else f'project{i}'
+            targets = range(routes) if i == rules - 1 else [i % routes]
+            f.write(f"- name: rule{i}\n" +
+                    "  headers:\n    X-Gitlab-Event: Push Hook\n" +
+                    f"  when: JSON['project']['name'] == '{project}'\n" +
+                    "  template: bench.j2\n  routes:\n" +
+                    ''.join(f'    - r{j}\n' for j in targets))
+
+def rss(pid):
+# resident memory in kilobytes, None where /proc is not available
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return(int(line.split()[1]))
+    except OSError:
+        pass
+    return(None)
+
+def percentile(values, share):
+    if not values:
+        return(None)
+    values = sorted(values)
+    return(values[min(int(len(values) * share), len(values) - 1)])
+
+async def start_stub(port, latency, errors, received):
+    async def handler(request):
+        body = await request.json()
+        if latency:
+            await asyncio.sleep(latency)
+        if random.random() < errors:
+            raise web.HTTPInternalServerError
+        received.append((body['id'], time.perf_counter()))
+        raise web.HTTPOk
+
+    app = web.Application()
+    app.add_routes([web.post('/{route}', handler)])
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', port).start()
+    return(runner)
+
+async def wait_app(session, url, process):
+    started = time.monotonic()
+    while time.monotonic() - started < APPSTARTTIMEOUT:
+        if process.poll() is not None:
+            return(False)
+        try:
+            async with session.get(url + 'metrics') as resp:
+                if resp.status == 200:
+                    return(True)
+        except OSError:
+            pass
+        await asyncio.sleep(0.1)
+    return(False)
+
+async def send_events(session, url, payloads, events, concurrency, sent):
+    statuses = {}
+    ids = iter(range(events))
+
+    async def sender():
+        for id_ in ids:
+            payload = dict(payloads[id_ % len(payloads)])
+            payload.update({'bench_id': id_,
+                            'project': dict(payload['project'],
+                                            name='bench')})
+            body = json.dumps(payload)
+            sent.update({id_: time.perf_counter()})
+            async with session.post(url, data=body, headers={
+                    'X-Gitlab-Event': 'Push Hook',
+                    'Content-Type': 'application/json'}) as resp:
+                await resp.read()
+                statuses.update({resp.status:
+                                 statuses.get(resp.status, 0) + 1})
+
+    await asyncio.gather(*[sender() for i in range(concurrency)])
+    return(statuses)
+
+async def run_case(arguments, rules, routes, payloads):
+    stub_port = free_port()
+    app_port = free_port()
+    received = []
+    sent = {}
+    stub = await start_stub(stub_port, arguments.latency, arguments.errors,
+                            received)
+    with tempfile.TemporaryDirectory() as confdir:
+        write_config(confdir, rules, routes, stub_port)
+        command = [sys.executable, os.path.join(BENCHDIR, 'webrehook.py'),
+                   '--confdir', confdir, '--port', str(app_port),
+                   '--verbose', '30', '--journal', ''] + \
+                  shlex.split(arguments.app_args)
+        process = subprocess.Popen(command)
+        url = f'http://127.0.0.1:{app_port}/'
+        try:
+            async with ClientSession() as session:
+                started = time.perf_counter()
+                if not await wait_app(session, url, process):
+                    print('run_case: webrehook did not start', file=sys.stderr)
+                    return(None)
+                startup = time.perf_counter() - started
+                rss_idle = rss(process.pid)
+
+                started = time.perf_counter()
+                statuses = await send_events(session, url, payloads,
+                    arguments.events, arguments.concurrency, sent)
+                ingest = time.perf_counter() - started
+
+                expected = arguments.events * routes
+                count = 0
+                idle = time.monotonic()
+                while len(received) < expected and \
+                        time.monotonic() - idle < IDLETIMEOUT:
+                    if len(received) != count:
+                        count = len(received)
+                        idle = time.monotonic()
+                    await asyncio.sleep(0.05)
+                delivery = time.perf_counter() - started
+                rss_loaded = rss(process.pid)
+        finally:
+            process.terminate()
+            process.wait()
+            await stub.cleanup()
+
+    latencies = [at - sent[id_] for id_, at in received if id_ in sent]
+    return({'rules': rules,
+            'routes': routes,
+            'events': arguments.events,
+            'accepted': statuses.get(200, 0),
+            'delivered': len(received),
+            'expected': arguments.events * routes,
+            'startup_seconds': startup,
+            'ingest_per_second': arguments.events / ingest,
+            'delivered_per_second': len(received) / delivery,
+            'latency_p50': percentile(latencies, 0.5),
+            'latency_p99': percentile(latencies, 0.99),
+            'rss_idle_kb': rss_idle,
+            'rss_loaded_kb': rss_loaded})
+
+def format_value(value):
+    if isinstance(value, float):
+        return(f'{value:.4f}')
+    return(str(value))
+
+def report(results, previous):
+# previous results of the same case are printed after current ones
+    keys = {(result['rules'], result['routes']): result
+            for result in previous}
+    for result in results:
+        old = keys.get((result['rules'], result['routes']), {})
+        print(f"rules {result['rules']}, routes {result['routes']}:")
+        for name, value in result.items():
+            if name in ('rules', 'routes'):
+                continue
+            line = f'  {name}: {format_value(value)}'
+            if old.get(name) is not None and value is not None:
+                line += f' (was {format_value(old[name])})'
+            print(line)
+
+async def run(arguments):
+    payloads = load_payloads()
+    results = []
+    for rules in [int(value) for value in arguments.rules.split(',')]:
+        for routes in [int(value) for value in arguments.routes.split(',')]:
+            result = await run_case(arguments, rules, routes, payloads)
+            if result is not None:
+                results.append(result)
+    return(results)
+
+def main():
+    parser = argparse.ArgumentParser(description='Webhooks re-sender benchmark')
+    parser.add_argument('--rules', default='10,100,1000,10000',
+                        help='comma separated amounts of rules')
+    parser.add_argument('--routes', default='1,10,50',
+                        help='comma separated amounts of routes')
+    parser.add_argument('--events', default=2000, type=int,
+                        help='events sent in every case')
+    parser.add_argument('--concurrency', default=20, type=int,
+                        help='events sent at once')
+    parser.add_argument('--latency', default=0, type=float,
+                        help='stub destination response delay seconds')
+    parser.add_argument('--errors', default=0, type=float,
+                        help='share of stub destination 500 responses')
+    parser.add_argument('--app_args', default='',
+                        help='extra webrehook arguments')
+    parser.add_argument('--save', default='',
+                        help='file to save results to')
+    parser.add_argument('--compare', default='',
+                        help='saved results file to compare with')
+    arguments = parser.parse_args()
+
+    previous = []
+    if arguments.compare:
+        with open(arguments.compare) as f:
+            previous = json.load(f)['results']
+
+    results = asyncio.run(run(arguments))
+    report(results, previous)
+    if arguments.save:
+        with open(arguments.save, 'w') as f:
+            json.dump({'time': time.time(), 'arguments': vars(arguments),
+                       'results': results}, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+
+import gzip
+import jsoncodec
+import logging
+import os
+import queue
+import threading
+import time
+
+class Capture:
+# writes received requests to JSONL files readable by replay mode. Files are
+# written by separate thread from bounded buffer, records are dropped when
+# buffer is full, so slow disk never stalls event loop
+    def __init__(self, directory, name, max_bytes, max_seconds, compress,
+                 redact, size):
+        self.directory = directory
+        self.name = name
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.compress = compress
+        self.redact = {header.lower() for header in redact}
+        self.buffer = queue.Queue(maxsize=size)
+        self.file = None
+        self.written = 0
+        self.opened = 0
+        self.files = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self.thread.start()
+
+    def put(self, headers, body, rules, source=None):
+# returns False when record is dropped
+        try:
+            self.buffer.put_nowait((time.time(), headers, body, rules, source))
+        except queue.Full:
+            return(False)
+        return(True)
+
+    def stop(self):
+        self.buffer.put(None)
+        self.thread.join()
+
+    def record(self, received, headers, body, rules, source):
+        headers = {key: '[redacted]' if key.lower() in self.redact else value
+                   for key, value in headers.items()}
+        return(jsoncodec.dumps({'time': received,
+                                'headers': headers,
+                                'body': body.decode('utf-8', 'replace'),
+                                'rules': rules,
+                                'source': source}) + b'\n')
+
+    def rotate(self):
+        self.close()
+        stamp = time.strftime('%Y%m%d-%H%M%S')
+        self.files += 1
+        path = os.path.join(self.directory,
+                            f'capture-{self.name}-{stamp}-{self.files}.jsonl')
+        if self.compress:
+            self.file = gzip.open(path + '.gz', 'ab')
+        else:
+            self.file = open(path, 'ab')
+        self.written = 0
+        self.opened = time.monotonic()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def write(self, line):
+        if self.file is None or self.written >= self.max_bytes or \
+                time.monotonic() - self.opened >= self.max_seconds:
+            self.rotate()
+        self.file.write(line)
+        self.written += len(line)
+        if self.buffer.empty():
+            self.file.flush()
+
+    def run(self):
+        while True:
+            item = self.buffer.get()
+            if item is None:
+                break
+            try:
+                self.write(self.record(*item))
+            except OSError:
+                logging.warning(
+                    f'Capture: Unable to write to {self.directory}')
+                self.file = None
+        try:
+            self.close()
+        except OSError:
+            logging.warning('Capture: Unable to close capture file')
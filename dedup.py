@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+
+import hashlib
+import time
+from collections import OrderedDict
+
+def event_key(headers, body, header, hash_body=False):
+# event identity is set by sender header, e.g. X-Gitlab-Event-UUID. When
+# sender does not set it, identity is hash of payload if hash_body is set,
+# otherwise None and event is not deduplicated, since different events
+# may have equal payloads
+    if header:
+        value = headers.get(header)
+        if value:
+            return(value)
+    if not hash_body:
+        return(None)
+    return(hashlib.blake2b(body, digest_size=16).digest())
+
+class DedupCache:
+# keys seen during last ttl seconds, at most size keys. Keys are kept in
+# insertion order, so oldest and expired ones are evicted from the front
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.seen = OrderedDict()
+
+    def expire(self, now):
+        while self.seen:
+            key, added = next(iter(self.seen.items()))
+            if now - added < self.ttl and len(self.seen) <= self.size:
+                break
+            self.seen.popitem(last=False)
+
+    def add(self, key):
+# returns False when key is already seen
+        now = time.monotonic()
+        self.expire(now)
+        if key in self.seen:
+            return(False)
+        self.seen[key] = now
+        self.expire(now)
+        return(True)
+
+    def remove(self, key):
+        self.seen.pop(key, None)
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+
+import asyncio
+import heapq
+import logging
+import os
+import random
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+def retry_delay(attempts, delay, max_delay, jitter):
+# exponential backoff: delay, 2 * delay, 4 * delay... up to max_delay,
+# spread by +-jitter share to not retry all failed deliveries at once
+    backoff = min(delay * 2 ** max(attempts - 1, 0), max_delay)
+    return(backoff * random.uniform(1 - jitter, 1 + jitter))
+
+class Delivery:
+# rendered body of one event for one route. Only rendered bytes are kept
+# for pending deliveries, parsed event is released after rendering. Body
+# compressed for route is kept with its Content-Encoding, so retries send
+# the same bytes without compressing again
+    __slots__ = ('id', 'route', 'rule', 'body', 'attempts', 'created',
+                 'source', 'encoding')
+
+    def __init__(self, route, rule, body, created, attempts=0, id_=None,
+                 source=None, encoding=None):
+        self.id = id_
+        self.route = route
+        self.rule = rule
+        self.body = body
+        self.attempts = attempts
+        self.created = created
+        self.source = source
+        self.encoding = encoding
+
+    def __eq__(self, other):
+        return(isinstance(other, Delivery) and
+               all(getattr(self, name) == getattr(other, name)
+                   for name in self.__slots__))
+
+class Journal:
+# sqlite journal of deliveries waiting for retry, all queries are run in
+# single separate thread to not block event loop on disk
+    def __init__(self, path):
+        self.path = path
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.db = None
+
+    def _open(self):
+        if self.db is not None:
+            return(self.db.execute(
+                'SELECT due, id FROM deliveries').fetchall())
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS deliveries ' +
+                        '(id INTEGER PRIMARY KEY, route TEXT, rule TEXT, ' +
+                        'body BLOB, attempts INTEGER, created REAL, due REAL)')
+        columns = [row[1] for row in
+                   self.db.execute('PRAGMA table_info(deliveries)')]
+        if 'source' not in columns:
+            self.db.execute('ALTER TABLE deliveries ADD COLUMN source TEXT')
+        if 'encoding' not in columns:
+            self.db.execute(
+                'ALTER TABLE deliveries ADD COLUMN encoding TEXT')
+        self.db.commit()
+        return(self.db.execute(
+            'SELECT due, id FROM deliveries').fetchall())
+
+    def _save(self, delivery, due, commit=True):
+        if delivery.id is None:
+            cursor = self.db.execute(
+                'INSERT INTO deliveries ' +
+                '(route, rule, body, attempts, created, due, source, ' +
+                'encoding) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (delivery.route, delivery.rule, delivery.body,
+                 delivery.attempts, delivery.created, due, delivery.source,
+                 delivery.encoding))
+            delivery.id = cursor.lastrowid
+        else:
+            self.db.execute(
+                'UPDATE deliveries SET attempts = ?, due = ? WHERE id = ?',
+                (delivery.attempts, due, delivery.id))
+        if commit:
+            self.db.commit()
+        return(delivery.id)
+
+    def _save_all(self, deliveries, due):
+        ids = [self._save(delivery, due, False) for delivery in deliveries]
+        self.db.commit()
+        return(ids)
+
+    def _load(self, id_):
+        row = self.db.execute(
+            'SELECT id, route, rule, body, attempts, created, source, ' +
+            'encoding FROM deliveries WHERE id = ?', (id_,)).fetchone()
+        if row is None:
+            return(None)
+        return(Delivery(row[1], row[2], row[3], row[5], row[4], row[0],
+                        row[6], row[7]))
+
+    def _adopt(self, path):
+# moves deliveries of other journal file into this one and removes it,
+# returns amount of moved deliveries
+        other = Journal(path)
+        other.executor.shutdown()
+        pending = other._open()
+        self._open()
+        for due, id_ in pending:
+            delivery = other._load(id_)
+            delivery.id = None
+            self._save(delivery, due, False)
+        self.db.commit()
+        other._close()
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+        return(len(pending))
+
+    def _remove(self, id_):
+        self.db.execute('DELETE FROM deliveries WHERE id = ?', (id_,))
+        self.db.commit()
+
+    def _close(self):
+        self.db.close()
+
+    async def call(self, method, *args):
+        loop = asyncio.get_running_loop()
+        return(await loop.run_in_executor(self.executor, method, *args))
+
+    async def open(self):
+        return(await self.call(self._open))
+
+    async def save(self, delivery, due):
+        return(await self.call(self._save, delivery, due))
+
+    async def save_all(self, deliveries, due):
+        return(await self.call(self._save_all, deliveries, due))
+
+    async def load(self, id_):
+        return(await self.call(self._load, id_))
+
+    async def adopt(self, path):
+        return(await self.call(self._adopt, path))
+
+    async def remove(self, id_):
+        await self.call(self._remove, id_)
+
+    async def close(self):
+        await self.call(self._close)
+        self.executor.shutdown()
+
+class RetryScheduler:
+# single task waking up due deliveries from heap of (due, id), delivery
+# bodies are kept in journal only, not in memory
+    def __init__(self, journal, enqueue):
+        self.journal = journal
+        self.enqueue = enqueue
+        self.heap = []
+        self.wakeup = asyncio.Event()
+
+    async def start(self):
+        self.heap = await self.journal.open()
+        heapq.heapify(self.heap)
+        if self.heap:
+            logging.info(
+                f'RetryScheduler: {len(self.heap)} deliveries restored')
+
+    async def schedule(self, delivery, due):
+        id_ = await self.journal.save(delivery, due)
+        heapq.heappush(self.heap, (due, id_))
+        if self.heap[0][1] == id_:
+            self.wakeup.set()
+
+    async def run(self):
+        while True:
+            self.wakeup.clear()
+            while self.heap and self.heap[0][0] <= time.time():
+                due, id_ = heapq.heappop(self.heap)
+                try:
+                    delivery = await self.journal.load(id_)
+                    if delivery is not None:
+                        await self.enqueue(delivery)
+                except asyncio.CancelledError:
+                    raise
+                except:
+                    logging.exception('RetryScheduler: Unexpected error')
+
+            timeout = None
+            if self.heap:
+                timeout = self.heap[0][0] - time.time()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
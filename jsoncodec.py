@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+
+import json
+import logging
+
+# faster JSON libraries are optional, stdlib json is used without them
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+CODECS = ['auto', 'orjson', 'ujson', 'json']
+
+def json_dumps(obj):
+    return(json.dumps(obj).encode('utf-8'))
+
+def ujson_dumps(obj):
+    return(ujson.dumps(obj).encode('utf-8'))
+
+# name, loads(str or bytes) raising ValueError, dumps(obj) returning bytes
+BACKENDS = {'json': (json.loads, json_dumps)}
+if ujson is not None:
+    BACKENDS.update({'ujson': (ujson.loads, ujson_dumps)})
+if orjson is not None:
+    BACKENDS.update({'orjson': (orjson.loads, orjson.dumps)})
+
+# codec in use, switched by use()
+CODEC = {'name': 'json', 'loads': json.loads, 'dumps': json_dumps}
+
+def use(name):
+# auto takes fastest installed backend, unavailable one falls back to json
+    if name == 'auto':
+        name = next(backend for backend in ('orjson', 'ujson', 'json')
+                    if backend in BACKENDS)
+    if name not in BACKENDS:
+        logging.warning(f'use: {name} is not installed, json is used')
+        name = 'json'
+    loads, dumps = BACKENDS[name]
+    CODEC.update({'name': name, 'loads': loads, 'dumps': dumps})
+    return(name)
+
+def loads(data):
+    return(CODEC['loads'](data))
+
+def dumps(obj):
+    return(CODEC['dumps'](obj))
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+
+import asyncio
+import email.utils
+import logging
+import math
+import time
+
+def parse_retry_after(value, max_delay):
+# Retry-After header is either delay seconds or http date, delay is clamped
+# to max_delay, so destination can not pause route for good
+    if value is None:
+        return(0)
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            date = email.utils.parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            logging.debug(f'parse_retry_after: Wrong Retry-After {value}')
+            return(0)
+        seconds = date.timestamp() - time.time()
+    if math.isnan(seconds):
+        return(0)
+    return(min(max(seconds, 0), max_delay))
+
+class TokenBucket:
+# rate tokens per second up to burst tokens, rate 0 is unlimited.
+# pause blocks all tokens for some time, e.g. on destination Retry-After
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.paused = 0
+
+    def delay(self):
+# takes token and returns 0 or returns seconds to wait for token
+        now = time.monotonic()
+        if now < self.paused:
+            return(self.paused - now)
+        if not self.rate:
+            return(0)
+        self.tokens = min(self.tokens + (now - self.updated) * self.rate,
+                          self.burst)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return(0)
+        return((1 - self.tokens) / self.rate)
+
+    async def acquire(self):
+        delay = self.delay()
+        while delay > 0:
+            await asyncio.sleep(delay)
+            delay = self.delay()
+
+    def pause(self, seconds):
+        self.paused = max(self.paused, time.monotonic() + seconds)
+
+class CircuitBreaker:
+# opens after failures in a row, failures 0 disables breaker. After reset
+# seconds one probe delivery is let through: success closes breaker,
+# failure opens it again, probe ended without response lets next one
+# through after reset
+    def __init__(self, name, failures, reset):
+        self.name = name
+        self.failures = failures
+        self.reset = reset
+        self.failed = 0
+        self.opened = None
+        self.probing = False
+
+    def allow(self):
+        if self.opened is None:
+            return(True)
+        if self.probing or time.monotonic() - self.opened < self.reset:
+            return(False)
+        self.probing = True
+        return(True)
+
+    def retry_after(self):
+        if self.opened is None:
+            return(0)
+        return(max(self.opened + self.reset - time.monotonic(), 0) or
+               self.reset)
+
+    def abort(self):
+        self.probing = False
+
+    def success(self):
+        self.failed = 0
+        self.opened = None
+        self.probing = False
+
+    def failure(self):
+        self.failed += 1
+        if self.probing or (self.failures and self.failed >= self.failures):
+            if self.opened is None or self.probing:
+                logging.warning(
+                    f'CircuitBreaker: {self.name} opened after ' +
+                    f'{self.failed} failures')
+            self.opened = time.monotonic()
+            self.probing = False
+
+class ByteBudget:
+# bytes of deliveries kept in memory, limit 0 is unlimited. Single delivery
+# larger than limit is let in when nothing else is kept
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.freed = asyncio.Event()
+
+    def full(self):
+        return(bool(self.limit) and self.used >= self.limit)
+
+    def take(self, size):
+        if self.limit and self.used and self.used + size > self.limit:
+            return(False)
+        self.used += size
+        return(True)
+
+    async def acquire(self, size):
+        while not self.take(size):
+            self.freed.clear()
+            await self.freed.wait()
+
+    def release(self, size):
+        self.used -= size
+        self.freed.set()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+import time
+
+class RateLimitFilter(logging.Filter):
+# passes at most burst records of every message type at once, refilled by
+# rate records per second, 0 rate passes everything. Message type is the
+# logging call site, so records differing only in args share the limit.
+# Amount of suppressed records is shown with next passed one of the type
+    def __init__(self, rate, burst):
+        super().__init__()
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.types = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        if self.rate <= 0:
+            return(True)
+        key = (record.pathname, record.lineno)
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated, suppressed = self.types.get(key,
+                                                         (self.burst, now, 0))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if tokens < 1:
+                self.types[key] = (tokens, now, suppressed + 1)
+                return(False)
+            self.types[key] = (tokens - 1, now, 0)
+        if suppressed:
+            record.suppressed = suppressed
+        return(True)
+
+class TruncatingFormatter(logging.Formatter):
+# cuts formatted message to limit characters, 0 is unlimited. Tracebacks
+# are kept whole
+    def __init__(self, fmt, limit):
+        super().__init__(fmt)
+        self.limit = limit
+
+    def formatMessage(self, record):
+        message = record.message
+        if self.limit and len(message) > self.limit:
+            message = message[:self.limit] + \
+                f'... [{len(message) - self.limit} more characters]'
+        if getattr(record, 'suppressed', 0):
+            message += f' [{record.suppressed} similar messages suppressed]'
+        if getattr(record, 'dropped', 0):
+            message += f' [{record.dropped} messages dropped before]'
+        record.message = message
+        return(super().formatMessage(record))
+
+class BackgroundHandler(logging.handlers.QueueHandler):
+# queues records as they are, so message args and tracebacks are formatted
+# in listener thread instead of event loop. Records are dropped when queue
+# is full, so slow stderr never stalls event loop
+    def __init__(self, size):
+        super().__init__(queue.Queue(maxsize=size))
+        self.dropped = 0
+
+    def prepare(self, record):
+        return(record)
+
+    def enqueue(self, record):
+        if self.dropped:
+            record.dropped = self.dropped
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            return
+        self.dropped = 0
+
+# listener and process it runs in, forked workers start their own one
+LISTENER = {'listener': None, 'pid': None}
+
+def setup_logging(level, rate, burst, truncate, size):
+# replaces root logger handlers with background one writing to stderr
+    stop_logging()
+    stream = logging.StreamHandler()
+    stream.setFormatter(TruncatingFormatter(logging.BASIC_FORMAT, truncate))
+    handler = BackgroundHandler(size)
+    handler.addFilter(RateLimitFilter(rate, burst))
+    root = logging.getLogger()
+    for old in list(root.handlers):
+        root.removeHandler(old)
+    root.addHandler(handler)
+    root.setLevel(level)
+    listener = logging.handlers.QueueListener(handler.queue, stream)
+    listener.start()
+    LISTENER.update({'listener': listener, 'pid': os.getpid()})
+    return(handler)
+
+def stop_logging():
+# writes queued records and stops listener thread. Listener inherited by
+# fork has no thread in this process, so it is only forgotten
+    listener = LISTENER['listener']
+    pid = LISTENER['pid']
+    LISTENER.update({'listener': None, 'pid': None})
+    if listener is not None and pid == os.getpid():
+        listener.stop()
+
+atexit.register(stop_logging)
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+
+from bisect import bisect_left
+
+# seconds
+DEFAULTBUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5,
+                  10, 30)
+
+def format_labels(names, values, extra=''):
+    labels = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    if not labels:
+        return('')
+    return('{' + ','.join(labels) + '}')
+
+def escape(value):
+    return(str(value).replace('\\', '\\\\').replace('"', '\\"')
+           .replace('\n', '\\n'))
+
+def format_value(value):
+    if isinstance(value, float) and value.is_integer():
+        return(str(int(value)))
+    return(str(value))
+
+class Counter:
+# values are kept by labels values tuple, () when metric has no labels
+    kind = 'counter'
+
+    def __init__(self, name, help_, labels=()):
+        self.name = name
+        self.help = help_
+        self.labels = labels
+        self.values = {}
+
+    def inc(self, labels=(), value=1):
+        self.values[labels] = self.values.get(labels, 0) + value
+
+    def samples(self):
+        for labels, value in self.values.items():
+            yield(self.name, format_labels(self.labels, labels), value)
+
+    def copy(self):
+        return(Counter(self.name, self.help, self.labels))
+
+    def snapshot(self):
+        return([[list(labels), value] for labels, value in self.values.items()])
+
+    def merge(self, snapshot):
+        for labels, value in snapshot:
+            self.inc(tuple(labels), value)
+
+class Gauge(Counter):
+# either set directly or collected from function returning
+# {labels values tuple: value} on every render
+    kind = 'gauge'
+
+    def __init__(self, name, help_, labels=(), collect=None):
+        super().__init__(name, help_, labels)
+        self.collect = collect
+
+    def set(self, value, labels=()):
+        self.values[labels] = value
+
+    def dec(self, labels=(), value=1):
+        self.inc(labels, -value)
+
+    def samples(self):
+        if self.collect is not None:
+            self.values = self.collect()
+        return(super().samples())
+
+    def copy(self):
+        return(Gauge(self.name, self.help, self.labels))
+
+    def snapshot(self):
+        if self.collect is not None:
+            self.values = self.collect()
+        return(super().snapshot())
+
+class Histogram:
+# bucket counts are kept non cumulative and summed on render only
+    kind = 'histogram'
+
+    def __init__(self, name, help_, labels=(), buckets=DEFAULTBUCKETS):
+        self.name = name
+        self.help = help_
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self.values = {}
+
+    def observe(self, value, labels=()):
+        series = self.values.get(labels)
+        if series is None:
+            series = [[0] * (len(self.buckets) + 1), 0, 0]
+            self.values[labels] = series
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def samples(self):
+        for labels, (counts, sum_, count) in self.values.items():
+            total = 0
+            for bucket, bucket_count in zip(self.buckets + ('+Inf',), counts):
+                total += bucket_count
+                yield(self.name + '_bucket',
+                      format_labels(self.labels, labels, f'le="{bucket}"'),
+                      total)
+            yield(self.name + '_sum', format_labels(self.labels, labels), sum_)
+            yield(self.name + '_count', format_labels(self.labels, labels),
+                  count)
+
+    def copy(self):
+        return(Histogram(self.name, self.help, self.labels, self.buckets))
+
+    def snapshot(self):
+        return([[list(labels), series]
+                for labels, series in self.values.items()])
+
+    def merge(self, snapshot):
+        for labels, (counts, sum_, count) in snapshot:
+            series = self.values.get(tuple(labels))
+            if series is None:
+                series = [[0] * (len(self.buckets) + 1), 0, 0]
+                self.values[tuple(labels)] = series
+            series[0] = [a + b for a, b in zip(series[0], counts)]
+            series[1] += sum_
+            series[2] += count
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+
+    def add(self, metric):
+        self.metrics.update({metric.name: metric})
+        return(metric)
+
+    def counter(self, name, help_, labels=()):
+        return(self.add(Counter(name, help_, labels)))
+
+    def gauge(self, name, help_, labels=(), collect=None):
+        return(self.add(Gauge(name, help_, labels, collect)))
+
+    def histogram(self, name, help_, labels=(), buckets=DEFAULTBUCKETS):
+        return(self.add(Histogram(name, help_, labels, buckets)))
+
+    def copy(self):
+# empty registry with the same metrics, to merge snapshots into
+        registry = Registry()
+        for metric in self.metrics.values():
+            registry.add(metric.copy())
+        return(registry)
+
+    def snapshot(self):
+        return({name: metric.snapshot()
+                for name, metric in self.metrics.items()})
+
+    def merge(self, snapshot):
+        for name, values in snapshot.items():
+            if name in self.metrics:
+                self.metrics[name].merge(values)
+
+    def render(self):
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for name, labels, value in metric.samples():
+                lines.append(f'{name}{labels} {format_value(value)}')
+        return('\n'.join(lines) + '\n')
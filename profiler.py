@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+
+class RuleProfiler:
+# header match and when evaluation seconds of rules in sampled events,
+# kept by (source, rule name), so stats survive reloads of unchanged rules
+    def __init__(self, top):
+        self.top = top
+        self.rules = {}
+
+    def record(self, source, name, headers_seconds, when_seconds):
+        stats = self.rules.get((source, name))
+        if stats is None:
+            stats = [0, 0, 0, 0]
+            self.rules.update({(source, name): stats})
+        stats[0] += 1
+        stats[1] += headers_seconds
+        stats[2] += when_seconds
+        stats[3] = max(stats[3], headers_seconds + when_seconds)
+
+    def table(self):
+# top rules by mean evaluation seconds
+        rows = []
+        for (source, name), (count, headers, when, max_) in \
+                self.rules.items():
+            rows.append({'source': source,
+                         'rule': name,
+                         'samples': count,
+                         'headers_seconds': headers / count,
+                         'when_seconds': when / count,
+                         'mean_seconds': (headers + when) / count,
+                         'max_seconds': max_})
+        rows.sort(key=lambda row: row['mean_seconds'], reverse=True)
+        return(rows[:self.top])
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+
+import difflib
+import gzip
+import jsoncodec
+import logging
+import os
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from multidict import CIMultiDict
+from webrehook import CONFDIRARG, JSONCODECARG, REPLAYARG, \
+    REPLAYCOMPAREARG, REPLAYDELIVERARG, REPLAYPROCESSESARG, SENDHEADERS, \
+    candidate_rules, evaluate_rules, headers_match, prepare_config, \
+    render_template
+
+# events sent to process pool at once
+REPLAYCHUNK = 256
+# max rendered output diffs printed in report
+REPLAYDIFFS = 10
+
+# configs prepared once in every pool process
+CONFIGS = []
+
+def replay_init(arguments):
+    jsoncodec.use(arguments[JSONCODECARG])
+    CONFIGS.clear()
+    confdirs = [arguments[CONFDIRARG]]
+    if arguments[REPLAYCOMPAREARG]:
+        confdirs.append(arguments[REPLAYCOMPAREARG])
+    for confdir in confdirs:
+        config, cache = prepare_config(
+            dict(arguments, **{CONFDIRARG: confdir}))
+        if config is None:
+            raise ValueError(f'replay_init: Wrong config in {confdir}')
+        CONFIGS.append(config)
+
+def read_event(line):
+# archive line is {"headers": {...}, "body": ..., "source": ...}, body is
+# either raw request body string or already decoded JSON, source is
+# sources.yml source the request was received for, absent for /
+    event = jsoncodec.loads(line)
+    body = event.get('body')
+    if isinstance(body, str):
+        body = jsoncodec.loads(body)
+    return(CIMultiDict(event.get('headers') or {}), body, event.get('source'))
+
+def replay_event(config, JSON, headers, source=None):
+# returns [(rule name, rendered body)] of matched rules, batch rules are
+# rendered as batch of one event
+    if source is not None:
+        config = config['sources'].get(source)
+        if config is None:
+            return([])
+    if not headers_match(config['prefilter'], headers):
+        return([])
+    rules = config['rules']
+    memo = {}
+    candidates = candidate_rules(config['index'], JSON, headers, memo)
+    matched = []
+    for i, when_matched, elapsed in evaluate_rules(rules, candidates, JSON,
+                                                   headers, memo):
+        if not when_matched:
+            continue
+        rule = rules[i]
+        if rule.get('batch') is not None:
+            body = render_template(
+                config['templates'][rule['batch']['template']], JSON,
+                rule['name'], [JSON])
+        else:
+            body = render_template(config['templates'][rule['template']],
+                                   JSON, rule['name'])
+        matched.append((rule['name'], body))
+    return(matched)
+
+def deliver(url, config, matched):
+# posts rendered bodies to url/<route> instead of real route urls
+    for name, body in matched:
+        if body is None:
+            continue
+        rule = next(rule for rule in config['rules'] if rule['name'] == name)
+        for route in rule['routes']:
+            request = urllib.request.Request(f'{url}/{route}', data=body,
+                                             headers=SENDHEADERS)
+            try:
+                with urllib.request.urlopen(request, timeout=10) as resp:
+                    resp.read()
+            except (urllib.error.URLError, OSError):
+                logging.warning(f'deliver: Unable to deliver {name} to {url}')
+
+def replay_chunk(lines, url):
+# returns [(line number, [matched per config])], None instead of matched
+# for broken lines
+    results = []
+    for number, line in lines:
+        try:
+            headers, JSON, source = read_event(line)
+        except (ValueError, AttributeError, TypeError):
+            results.append((number, None))
+            continue
+        matched = [replay_event(config, JSON, headers, source)
+                   for config in CONFIGS]
+        if url:
+            deliver(url, CONFIGS[0]['sources'].get(source, CONFIGS[0]),
+                    matched[0])
+        results.append((number, matched))
+    return(results)
+
+def read_chunks(path):
+# gzip archives written by --capture_gzip are read as they are
+    chunk = []
+    if path.endswith('.gz'):
+        f = gzip.open(path, 'rt', encoding='utf-8')
+    else:
+        f = open(path, 'r', encoding='utf-8')
+    with f:
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            chunk.append((number, line))
+            if len(chunk) >= REPLAYCHUNK:
+                yield(chunk)
+                chunk = []
+    if chunk:
+        yield(chunk)
+
+def output_diff(number, before, after):
+    before = dict(before)
+    after = dict(after)
+    lines = []
+    for name in sorted(set(before) | set(after)):
+        old = (before.get(name) or b'').decode('utf-8').splitlines()
+        new = (after.get(name) or b'').decode('utf-8').splitlines()
+        if name not in before:
+            old = []
+        if name not in after:
+            new = []
+        lines.extend(difflib.unified_diff(old, new,
+            f'line {number} {name}', f'line {number} {name}', lineterm=''))
+    return(lines)
+
+def report(stats, elapsed):
+    print(f"events: {stats['events']}, broken: {stats['broken']}, " +
+          f"seconds: {elapsed:.3f}, " +
+          f"events per second: {stats['events'] / elapsed:.1f}")
+    names = sorted(set(stats['matches'][0]) | set(stats['matches'][-1]))
+    print('rule matches:')
+    for name in names:
+        counts = [str(matches.get(name, 0)) for matches in stats['matches']]
+        print(f"  {name}: {' -> '.join(counts)}")
+    if len(stats['matches']) > 1:
+        print(f"events with different output: {stats['different']}")
+        for number, before, after in stats['diffs']:
+            print('\n'.join(output_diff(number, before, after)))
+
+def replay(arguments):
+# runs archive through rules of confdir and optionally of compare confdir
+# in process pool, returns exit code
+    processes = arguments[REPLAYPROCESSESARG] or os.cpu_count()
+    try:
+        replay_init(arguments)
+    except ValueError:
+        logging.error('replay: Wrong config. Exiting.')
+        return(1)
+
+    stats = {'events': 0, 'broken': 0, 'different': 0, 'diffs': [],
+             'matches': [{} for config in CONFIGS]}
+
+    def collect(results):
+        for number, matched in results:
+            stats['events'] += 1
+            if matched is None:
+                stats['broken'] += 1
+                continue
+            for matches, config_matched in zip(stats['matches'], matched):
+                for name, body in config_matched:
+                    matches.update({name: matches.get(name, 0) + 1})
+            if len(matched) > 1 and matched[0] != matched[1]:
+                stats['different'] += 1
+                stats['diffs'].append((number, matched[0], matched[1]))
+                stats['diffs'] = sorted(stats['diffs'])[:REPLAYDIFFS]
+
+    started = time.perf_counter()
+    try:
+        with ProcessPoolExecutor(processes, initializer=replay_init,
+                                 initargs=(arguments,)) as executor:
+# at most two chunks per process are kept in flight, so archive is streamed
+            pending = set()
+            for chunk in read_chunks(arguments[REPLAYARG]):
+                if len(pending) >= processes * 2:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        collect(future.result())
+                pending.add(executor.submit(replay_chunk, chunk,
+                                            arguments[REPLAYDELIVERARG]))
+            for future in pending:
+                collect(future.result())
+    except (OSError, EOFError, UnicodeDecodeError):
+        logging.error(f'replay: Unable to read {arguments[REPLAYARG]}')
+        return(1)
+
+    report(stats, max(time.perf_counter() - started, 1e-9))
+    return(0)
@@ -1,6 +1,13 @@
 #!/usr/bin/env python3
 import pytest
 from webrehook import *
+from replay import replay, replay_chunk, replay_init
+from logqueue import BackgroundHandler, RateLimitFilter, TruncatingFormatter
+from metrics import Counter
+import gzip
+import zlib
+import logging
+import json
 
 @pytest.fixture(scope="function", params=[
     ({'a': 'eherhejtyj/ewreh/erh'}, False),
@@ -9,6 +16,12 @@ from webrehook import *
     ({'a': 'http://ya.ru/wewg/utuk?name=ferret&color=purple'}, True),
     ({'a': 'https://eherhejtyj/ewreh/erh'}, False),
     ({'a': 'https://ya.ru/wewg/utuk?name=ferret&color=purple'}, True),
+    ({'a': {'url': 'https://ya.ru/wewg', 'limit_per_host': 4}}, True),
+    ({'a': {'url': 'https://ya.ru/wewg', 'keepalive': 0}}, True),
+    ({'a': {'limit_per_host': 4}}, False),
+    ({'a': {'url': 'https://ya.ru/wewg', 'limit_per_host': -1}}, False),
+    ({'a': {'url': 'https://ya.ru/wewg', 'dns_ttl': 'a'}}, False),
+    ({'a': {'url': 'https://ya.ru/wewg', 'unknown': 1}}, False),
     ])
 def param_check_routes(request):
     return request.param
@@ -18,6 +31,14 @@ def test_check_routes(param_check_routes):
     result = check_routes(input_data)
     assert result == expected_output
 
+def test_prepare_routes():
+    result = prepare_routes({'a': 'https://ya.ru/a',
+                             'b': {'url': 'https://ya.ru/b', 'limit': 4}})
+    assert result['a'] == dict(ROUTEDEFAULTS, url='https://ya.ru/a')
+    assert result['b']['url'] == 'https://ya.ru/b'
+    assert result['b']['limit'] == 4
+    assert result['b']['keepalive'] == ROUTEDEFAULTS['keepalive']
+
 @pytest.fixture(scope="function", params=[
 # using '"' as str border
     ('JSON["user_name"] == "John Smith"',
@@ -96,3 +117,921 @@ def test_params(params_test_params):
         params_test_params["input"], params_test_params["output"]
     assert input_data == expected_output
 
+
+@pytest.fixture(scope="function", params=[
+    ('reject', False, [1, 2]),
+    ('drop_oldest', True, [2, 3]),
+    ])
+def params_put_queue(request):
+    return request.param
+
+def test_put_queue(params_put_queue):
+    (policy, expected_output, expected_items) = params_put_queue
+
+    async def fill():
+        queue = asyncio.Queue(maxsize=2)
+        await put_queue(queue, 1, policy)
+        await put_queue(queue, 2, policy)
+        result = await put_queue(queue, 3, policy)
+        return(result, [queue.get_nowait() for i in range(queue.qsize())])
+
+    assert asyncio.run(fill()) == (expected_output, expected_items)
+
+@pytest.fixture(scope="function", params=[
+    ("JSON['user_name'] == 'John Smith'", [(('user_name',), 'John Smith')]),
+    ("'John Smith' == JSON['user_name']", [(('user_name',), 'John Smith')]),
+    ("(JSON['a'][0] == 1 and JSON['b'] == True) and JSON['c'] != 'c'",
+        [(('a', 0), 1), (('b',), True)]),
+    ("JSON['a'] == 1 or JSON['b'] == 2", []),
+    ("not JSON['a'] == 1", []),
+    ("JSON['a'] == JSON['b']", []),
+    ])
+def params_equality_predicates(request):
+    return request.param
+
+def test_equality_predicates(params_equality_predicates):
+    (input_data, expected_output) = params_equality_predicates
+    result = equality_predicates(parse_when(input_data))
+    assert result == expected_output
+
+def test_candidate_rules():
+    rules = [{'headers': {'X-Gitlab-Event': 'Push Hook'}},
+             {'headers': {'X-Gitlab-Event': 'Push Hook'}},
+             {},
+             {'headers': {'X-Gitlab-Event': 'Tag Push Hook'}},
+             {'headers': {'X-Gitlab-Event': 'Push Hook'}}]
+    predicates = [[(('project', 'name'), 'a')],
+                  [(('project', 'name'), 'b')],
+                  [],
+                  [],
+                  []]
+    index = index_rules(rules, predicates, {})
+    headers = {'X-Gitlab-Event': 'Push Hook'}
+    JSON = {'project': {'name': 'b'}}
+    assert candidate_rules(index, JSON, headers, {}) == [1, 2, 4]
+    assert candidate_rules(index, {}, {}, {}) == [2]
+
+@pytest.fixture(scope="function", params=[
+    ("JSON['user_name'] == 'John Smith'", {'user_name': 'John Smith'}),
+    ("JSON['user_name'] == 'John Smith'", {'user_name': 'Jane Smith'}),
+    ("JSON['a'] == 1 and JSON['b'] == 2 or JSON['c'] == 3",
+        {'a': 1, 'b': 3, 'c': 3}),
+    ("not JSON['a'] == 1 and JSON['b'] is None", {'a': 2}),
+    ("(JSON['commits'][0] is not None) and " +
+     "(JSON['commits'][0]['author']['name'] == 'Jordi Mallach')",
+        {'commits': [{'author': {'name': 'Jordi Mallach'}}]}),
+    ("JSON['commits'][1]['id'] == None", {'commits': [{'id': 1}]}),
+    ("False in JSON['false'] and True not in JSON['false']",
+        {'false': [False, 0]}),
+    ("JSON['a'] + 1 == JSON['b'] - 1 == 2", {'a': 1, 'b': 3}),
+    ("JSON['a'][JSON['b']] == 'x'", {'a': {'y': 'x'}, 'b': 'y'}),
+    ])
+def params_compile_closure(request):
+    return request.param
+
+def test_compile_closure(params_compile_closure):
+    (input_data, input_json) = params_compile_closure
+    source = parse_when(input_data)
+    when = compile_closure(source, {}, WHENNAMES)
+    expected_output = eval_when(compile(source, 'string', 'eval'))(
+        input_json, {})
+    assert when(input_json, {}) == expected_output
+
+@pytest.fixture(scope="function", params=[
+    ([{'headers': {'a': '1', 'b': '2'}}, {'headers': {'a': '3'}}],
+        {'a': '1', 'b': '2'}, True),
+    ([{'headers': {'a': '1', 'b': '2'}}, {'headers': {'a': '3'}}],
+        {'a': '1'}, False),
+    ([{'headers': {'a': '1', 'b': '2'}}, {'headers': {'a': '3'}}],
+        {'a': '3', 'b': '2'}, True),
+    ([{'headers': {'a': '1'}}, {}], {}, True),
+    ])
+def params_headers_prefilter(request):
+    return request.param
+
+def test_headers_prefilter(params_headers_prefilter):
+    (input_rules, input_headers, expected_output) = params_headers_prefilter
+    prefilter = headers_prefilter(input_rules)
+    assert headers_match(prefilter, input_headers) == expected_output
+
+@pytest.fixture(scope="function", params=[
+    ('{"name": "{{ JSON["user_name"] }}"}', {'user_name': 'John Smith'},
+        b'{"name": "John Smith"}'),
+    ('{"name": {{ JSON["user_name"] }}}', {'user_name': 'John Smith'}, None),
+    ])
+def params_render_template(request):
+    return request.param
+
+def test_render_template(params_render_template):
+    (input_template, input_json, expected_output) = params_render_template
+    template = jinja2.Template(input_template)
+    assert render_template(template, input_json, 'a') == expected_output
+
+@pytest.fixture(scope="function", params=[
+    (1, 5, 300, 0, 5),
+    (2, 5, 300, 0, 10),
+    (4, 5, 300, 0, 40),
+    (10, 5, 300, 0, 300),
+    ])
+def params_retry_delay(request):
+    return request.param
+
+def test_retry_delay(params_retry_delay):
+    (attempts, delay, max_delay, jitter, expected_output) = params_retry_delay
+    assert retry_delay(attempts, delay, max_delay, jitter) == expected_output
+    assert expected_output * 0.9 <= \
+        retry_delay(attempts, delay, max_delay, 0.1) <= expected_output * 1.1
+
+def test_journal(tmp_path):
+    path = str(tmp_path / 'journal.sqlite')
+    delivery = Delivery('a', 'b', b'{}', 1.0, 1, encoding='gzip')
+
+    async def save():
+        scheduler = RetryScheduler(Journal(path), None)
+        await scheduler.start()
+        await scheduler.schedule(delivery, 2.0)
+        await scheduler.journal.close()
+
+    async def restore():
+        journal = Journal(path)
+        pending = await journal.open()
+        loaded = await journal.load(pending[0][1])
+        await journal.remove(loaded.id)
+        left = await journal.open()
+        await journal.close()
+        return(pending, loaded, left)
+
+    asyncio.run(save())
+    pending, loaded, left = asyncio.run(restore())
+    assert pending == [(2.0, delivery.id)]
+    assert loaded == delivery
+    assert left == []
+
+@pytest.fixture(scope="function", params=[
+    (None, 0),
+    ('5', 5),
+    ('-5', 0),
+    ('Wed, 21 Oct 2015 07:28:00 GMT', 0),
+    ('soon', 0),
+    ('inf', 60),
+    ('nan', 0),
+    ('86400', 60),
+    ])
+def params_parse_retry_after(request):
+    return request.param
+
+def test_parse_retry_after(params_parse_retry_after):
+    (input_data, expected_output) = params_parse_retry_after
+    assert parse_retry_after(input_data, 60) == expected_output
+
+def test_token_bucket():
+    bucket = TokenBucket(1, 2)
+    assert bucket.delay() == 0
+    assert bucket.delay() == 0
+    assert 0 < bucket.delay() <= 1
+    unlimited = TokenBucket(0, 1)
+    assert [unlimited.delay() for i in range(10)] == [0] * 10
+    unlimited.pause(10)
+    assert 9 < unlimited.delay() <= 10
+
+def test_circuit_breaker():
+    breaker = CircuitBreaker('a', 2, 0)
+    breaker.failure()
+    assert breaker.allow()
+    breaker.failure()
+    assert breaker.opened is not None
+# reset is 0, so only one probe is let through
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.success()
+    assert breaker.allow()
+    assert breaker.allow()
+# probe ended without response lets next probe through
+    breaker.failure()
+    breaker.failure()
+    assert breaker.allow()
+    breaker.abort()
+    assert breaker.allow()
+    assert not breaker.allow()
+    disabled = CircuitBreaker('a', 0, 30)
+    for i in range(10):
+        disabled.failure()
+    assert disabled.allow()
+
+def test_batch():
+    template = jinja2.Template(
+        '[{% for JSON in JSONS %}{{ JSON["a"] }}{{ "," if not loop.last }}' +
+        '{% endfor %}]')
+    rules = [{'name': 'a', 'routes': ['a'], 'template': 'a',
+              'batch': {'events': 2, 'ms': 10, 'template': 'a'}}]
+
+    async def batch():
+        app_config = {'source': None,
+                      'rules': rules,
+                      'templates': {'a': template},
+                      'arguments': {OVERFLOWARG: 'reject'},
+                      'queue': None,
+                      'route_state': {'a': {'queue': asyncio.Queue(),
+                                            'settings': ROUTEDEFAULTS}},
+                      'budget': ByteBudget(0),
+                      'batches': {},
+                      'batch_tasks': set(),
+                      'open_batches': {}}
+        app_config['metrics'] = prepare_metrics(app_config)
+        for i in range(3):
+            await add_to_batch(app_config, 0, {'a': i})
+# encoded events are counted until batch is rendered
+        assert app_config['budget'].used == len(b'{"a": 0}') * 3
+        await asyncio.sleep(0.1)
+# only rendered deliveries are left in budget
+        assert app_config['budget'].used == 6 + 3
+        queue = app_config['route_state']['a']['queue']
+        return([queue.get_nowait().body for i in range(queue.qsize())])
+
+    assert asyncio.run(batch()) == [b'[0, 1]', b'[2]']
+
+def test_budget_drop_oldest():
+    rule = {'name': 'a', 'routes': ['a', 'b']}
+
+    async def deliveries():
+        app_config = {'source': None,
+                      'arguments': {OVERFLOWARG: 'drop_oldest'},
+                      'queue': None,
+                      'route_state': {},
+                      'source_state': {},
+                      'budget': ByteBudget(10)}
+        for name in ('a', 'b'):
+            app_config['route_state'].update({name: {
+                'queue': asyncio.Queue(), 'settings': ROUTEDEFAULTS}})
+        app_config['metrics'] = prepare_metrics(app_config)
+        await queue_deliveries(app_config, rule, b'12345')
+        await queue_deliveries(app_config, rule, b'67890')
+        return([[delivery.body for delivery in state['queue']._queue]
+                for state in app_config['route_state'].values()],
+               app_config['budget'].used,
+               app_config['metrics']['route_dropped'].values)
+
+    assert asyncio.run(deliveries()) == \
+        ([[b'67890'], [b'67890']], 10, {('a',): 1, ('b',): 1})
+
+def test_batch_stop():
+    template = jinja2.Template('[{{ JSONS | length }}]')
+    rules = [{'name': 'a', 'routes': ['a'], 'template': 'a',
+              'batch': {'events': 10, 'ms': 100000, 'template': 'a'}}]
+
+    async def stop():
+        app_config = {'source': None,
+                      'rules': rules,
+                      'templates': {'a': template},
+                      'arguments': {OVERFLOWARG: 'reject'},
+                      'queue': None,
+                      'route_state': {'a': {'queue': asyncio.Queue(),
+                                            'settings': ROUTEDEFAULTS}},
+                      'source_state': {},
+                      'budget': ByteBudget(0),
+                      'batches': {},
+                      'batch_tasks': set(),
+                      'background_tasks': set(),
+                      'open_batches': {},
+                      'tasks': []}
+        app_config['metrics'] = prepare_metrics(app_config)
+        await add_to_batch(app_config, 0, {'a': 1})
+        await add_to_batch(app_config, 0, {'a': 2})
+        await stop_dispatch({'config': {'app_config': app_config}})
+        queue = app_config['route_state']['a']['queue']
+        return([queue.get_nowait().body for i in range(queue.qsize())],
+               app_config['open_batches'])
+
+    assert asyncio.run(stop()) == ([b'[2]'], {})
+
+def test_drop_delivery():
+    class Journal:
+        removed = []
+
+        async def remove(self, id):
+            self.removed.append(id)
+
+    async def drop():
+        app_config = {'route_state': {},
+                      'budget': ByteBudget(10),
+                      'scheduler': RetryScheduler(Journal(), None),
+                      'background_tasks': set()}
+        app_config['metrics'] = prepare_metrics(app_config)
+        app_config['budget'].take(3)
+        drop_delivery(app_config, Delivery('a', 'a', b'123', 0, id_=7))
+        await asyncio.gather(*app_config['background_tasks'])
+        return(Journal.removed, app_config['background_tasks'],
+               app_config['budget'].used)
+
+    assert asyncio.run(drop()) == ([7], set(), 0)
+
+def test_enqueue_retry_full():
+    class Journal:
+        async def save(self, delivery, due):
+            return(delivery.id)
+
+    async def enqueue():
+        queue = asyncio.Queue(maxsize=1)
+        queue.put_nowait(Delivery('a', 'a', b'1', 0, id_=1))
+        app_config = {'route_state': {'a': {'queue': queue}},
+                      'arguments': {OVERFLOWARG: 'block', RETRYDELAYARG: 5},
+                      'budget': ByteBudget(0),
+                      'scheduler': RetryScheduler(Journal(), None)}
+        await asyncio.wait_for(enqueue_retry(
+            app_config, Delivery('a', 'a', b'2', 0, id_=2)), 1)
+        return([id_ for due, id_ in app_config['scheduler'].heap],
+               queue.qsize(), app_config['budget'].used)
+
+    assert asyncio.run(enqueue()) == ([2], 1, 0)
+
+def test_check_admin():
+    class Request:
+        def __init__(self, headers):
+            self.headers = headers
+
+    app_config = {'arguments': {ADMINTOKENARG: 'secret'}}
+    check_admin(app_config, Request({'X-Admin-Token': 'secret'}))
+    for headers in ({}, {'X-Admin-Token': 'secre'},
+                    {'X-Admin-Token': 'secret\u0435'}):
+        with pytest.raises(web.HTTPForbidden):
+            check_admin(app_config, Request(headers))
+    with pytest.raises(web.HTTPForbidden):
+        check_admin({'arguments': {ADMINTOKENARG: ''}},
+                    Request({'X-Admin-Token': ''}))
+
+def test_stop_drain():
+    async def stop():
+        done = []
+        queue = asyncio.Queue()
+
+        async def worker():
+            while True:
+                item = await queue.get()
+                await asyncio.sleep(0.01)
+                done.append(item)
+                queue.task_done()
+
+        app_config = {'queue': queue,
+                      'source_state': {},
+                      'open_batches': {},
+                      'batch_tasks': set(),
+                      'background_tasks': set(),
+                      'tasks': [asyncio.create_task(worker())]}
+        for i in range(3):
+            queue.put_nowait(i)
+        await stop_dispatch({'config': {'app_config': app_config}})
+        return(done, app_config['tasks'])
+
+    assert asyncio.run(stop()) == ([0, 1, 2], [])
+
+def test_metrics():
+    registry = Registry()
+    counter = registry.counter('a_total', 'a', ('rule',))
+    histogram = registry.histogram('b_seconds', 'b', buckets=(1, 2))
+    gauge = registry.gauge('c', 'c', ('queue',), lambda: {('d"',): 3})
+    counter.inc(('x',))
+    counter.inc(('x',), 2)
+    histogram.observe(0.5)
+    histogram.observe(1.5)
+    histogram.observe(5)
+    assert registry.render() == \
+        '# HELP a_total a\n# TYPE a_total counter\na_total{rule="x"} 3\n' + \
+        '# HELP b_seconds b\n# TYPE b_seconds histogram\n' + \
+        'b_seconds_bucket{le="1"} 1\nb_seconds_bucket{le="2"} 2\n' + \
+        'b_seconds_bucket{le="+Inf"} 3\nb_seconds_sum 7\n' + \
+        'b_seconds_count 3\n' + \
+        '# HELP c c\n# TYPE c gauge\nc{queue="d\\""} 3\n'
+
+def test_metrics_merge():
+    registry = Registry()
+    registry.counter('a_total', 'a', ('route', 'status')).inc(('x', 200))
+    registry.histogram('b_seconds', 'b', buckets=(1,)).observe(0.5)
+    snapshot = json.loads(json.dumps(registry.snapshot()))
+    merged = registry.copy()
+    merged.merge(registry.snapshot())
+    merged.merge(snapshot)
+    assert merged.metrics['a_total'].values == {('x', 200): 2}
+    assert merged.metrics['b_seconds'].values == {(): [[2, 0], 1.0, 2]}
+
+def test_prepare_rules_cache(tmp_path):
+    (tmp_path / 'templates').mkdir()
+    (tmp_path / 'templates' / 'a.j2').write_text('{"a": 1}')
+    arguments = {CONFDIRARG: f'{tmp_path}/', DONEARG: True,
+                 WHENBACKENDARG: 'closure', TEMPLATECACHEARG: '',
+                 AUTOESCAPEARG: 'off', UNDEFINEDARG: 'default'}
+    routes = prepare_routes({'a': 'https://ya.ru/a'})
+    cache = new_cache()
+
+    def rules():
+        return([{'name': 'a', 'when': "JSON['a'] == 1", 'template': 'a.j2',
+                 'routes': ['a']}])
+
+    first, first_templates, index = prepare_rules(rules(), routes, arguments,
+                                                  cache)
+    second, second_templates, index = prepare_rules(rules(), routes,
+                                                    arguments, cache)
+    assert first[0]['when'] is second[0]['when']
+    assert first_templates['a.j2'] is second_templates['a.j2']
+    assert index['json'] == {('a',): {1: [0]}}
+
+def test_when_cache(tmp_path):
+    path = f'{tmp_path}/when.cache'
+    cache = new_cache()
+    when = "JSON['a'] == 1 and JSON['b'] == 'b'"
+    parsed = compile_when(when, 'a', cache)
+    save_when_cache(path, {when_hash(when): parsed})
+    cache['parsed'] = load_when_cache(path)
+    assert compile_when(when, 'a', cache) == parsed
+    assert eval_when(parsed[3])({'a': 1, 'b': 'b'}, {})
+
+    with open(path, 'wb') as f:
+        f.write(b'broken')
+    assert load_when_cache(path) == {}
+    assert load_when_cache(f'{tmp_path}/missing') == {}
+
+def test_template_environment(tmp_path):
+    (tmp_path / 'templates').mkdir()
+    (tmp_path / 'templates' / 'a.j2').write_text(
+        '{% from "macros.j2" import value %}{"a": {{ value(JSON.a) }}}')
+    (tmp_path / 'templates' / 'macros.j2').write_text(
+        '{% macro value(v) %}"{{ v }}"{% endmacro %}')
+    arguments = {CONFDIRARG: f'{tmp_path}/', TEMPLATECACHEARG: 'cache',
+                 AUTOESCAPEARG: 'off', UNDEFINEDARG: 'strict'}
+    cache = new_cache()
+    template_path = f'{tmp_path}/templates/'
+    environment = template_environment(template_path, arguments, cache)
+    templates = {}
+    assert load_template('a.j2', environment, templates, 'a')
+    assert not load_template('b.j2', environment, templates, 'b')
+    assert render_template(templates['a.j2'], {'a': 1}, 'a') == b'{"a": "1"}'
+    with pytest.raises(jinja2.UndefinedError):
+        templates['a.j2'].render(JSON={})
+    assert os.listdir(f'{tmp_path}/cache')
+
+    assert template_environment(template_path, arguments, cache) \
+        is environment
+    (tmp_path / 'templates' / 'macros.j2').write_text(
+        '{% macro value(v) %}{{ v }}{% endmacro %}')
+    environment = template_environment(template_path, arguments, cache)
+    templates = {}
+    assert load_template('a.j2', environment, templates, 'a')
+    assert render_template(templates['a.j2'], {'a': 1}, 'a') == b'{"a": 1}'
+
+def test_event_key():
+    assert event_key({'X-Id': 'a'}, b'{}', 'X-Id') == 'a'
+    assert event_key({}, b'{}', 'X-Id') is None
+    assert event_key({'X-Id': 'a'}, b'{}', 'X-Id', True) == 'a'
+    assert event_key({}, b'{}', 'X-Id', True) == event_key({}, b'{}', '', True)
+    assert event_key({}, b'{}', '', True) != \
+        event_key({}, b'{"a": 1}', '', True)
+
+def test_dedup_cache(monkeypatch):
+    now = [0]
+    monkeypatch.setattr(time, 'monotonic', lambda: now[0])
+    dedup = DedupCache(2, 10)
+    assert dedup.add('a')
+    assert not dedup.add('a')
+    assert dedup.add('b')
+    assert dedup.add('c')
+    assert list(dedup.seen) == ['b', 'c']
+    assert dedup.add('a')
+    now[0] = 10
+    assert dedup.add('c')
+    dedup.remove('c')
+    assert dedup.add('c')
+
+def test_replay_chunk(tmp_path):
+    (tmp_path / 'templates').mkdir()
+    (tmp_path / 'templates' / 'a.j2').write_text('{"a": {{ JSON.a }}}')
+    (tmp_path / 'routes.yml').write_text('a: https://ya.ru/a\n')
+    (tmp_path / 'rules.yml').write_text(
+        "- name: a\n  headers:\n    X-Event: push\n" +
+        "  when: JSON['a'] == 1\n  template: a.j2\n  routes:\n    - a\n")
+    arguments = {item['name']: item['default'] for item in ARGSTOPARSE}
+    arguments.update({CONFDIRARG: f'{tmp_path}/', WHENCACHEARG: '',
+                      TEMPLATECACHEARG: ''})
+    replay_init(arguments)
+    lines = [(1, '{"headers": {"x-event": "push"}, "body": "{\\"a\\": 1}"}'),
+             (2, '{"headers": {"X-Event": "push"}, "body": {"a": 2}}'),
+             (3, '{"headers": {}, "body": {"a": 1}}'),
+             (4, 'broken')]
+    assert replay_chunk(lines, '') == [(1, [[('a', b'{"a": 1}')]]),
+                                       (2, [[]]), (3, [[]]), (4, None)]
+
+@pytest.fixture(scope="function", params=[0, 1])
+def params_capture(request):
+    return(request.param)
+
+def test_capture(tmp_path, params_capture):
+    capture = Capture(f'{tmp_path}/capture', 'a', 10, 3600, params_capture,
+                      ['X-Token'], 2)
+    assert capture.put({'X-Token': 'a', 'X-Event': 'b'}, b'{"a": 1}', ['a'])
+    assert capture.put({}, b'{"a": 2}', [])
+    assert not capture.put({}, b'{"a": 3}', [])
+    capture.start()
+    capture.stop()
+
+    lines = []
+    for name in sorted(os.listdir(f'{tmp_path}/capture')):
+        path = f'{tmp_path}/capture/{name}'
+        with (gzip.open(path) if params_capture else open(path, 'rb')) as f:
+            lines.extend(json.loads(line) for line in f)
+    assert [line['body'] for line in lines] == ['{"a": 1}', '{"a": 2}']
+    assert lines[0]['headers'] == {'X-Token': '[redacted]', 'X-Event': 'b'}
+    assert lines[0]['rules'] == ['a']
+    assert len(os.listdir(f'{tmp_path}/capture')) == 2
+
+def test_capture_skipped(tmp_path):
+    capture = Capture(f'{tmp_path}/capture', 'a', 1000, 3600, 0, [], 1)
+    app_config = {'source': 's', 'capture': capture,
+                  'metrics': {'capture_dropped': Counter('a', 'a')}}
+    capture_skipped(app_config, {'X-Event': 'other'}, b'{"a": 1}')
+    capture_skipped(app_config, {}, b'{"a": 2}')
+    capture_skipped(app_config, {}, None)
+    assert capture.buffer.get_nowait()[1:] == \
+        ({'X-Event': 'other'}, b'{"a": 1}', [], 's')
+    assert app_config['metrics']['capture_dropped'].values == {(): 1}
+
+def test_capture_replay(tmp_path, params_capture, capsys):
+    (tmp_path / 'templates').mkdir()
+    (tmp_path / 'templates' / 'a.j2').write_text('{"a": {{ JSON.a }}}')
+    (tmp_path / 'routes.yml').write_text('a: https://ya.ru/a\n')
+    (tmp_path / 'rules.yml').write_text(
+        "- name: a\n  when: JSON['a'] == 1\n  template: a.j2\n" +
+        "  routes:\n    - a\n")
+    capture = Capture(f'{tmp_path}/capture', 'a', 1000, 3600, params_capture,
+                      [], 10)
+    capture.put({}, b'{"a": 1}', ['a'])
+    capture.put({}, b'{"a": 2}', [])
+    capture.start()
+    capture.stop()
+    name = os.listdir(f'{tmp_path}/capture')[0]
+    assert name.endswith('.gz') == bool(params_capture)
+    arguments = {item['name']: item['default'] for item in ARGSTOPARSE}
+    arguments.update({CONFDIRARG: f'{tmp_path}/', WHENCACHEARG: '',
+                      TEMPLATECACHEARG: '', REPLAYPROCESSESARG: 1,
+                      REPLAYARG: f'{tmp_path}/capture/{name}'})
+    assert replay(arguments) == 0
+    output = capsys.readouterr().out
+    assert 'events: 2, broken: 0' in output and '  a: 1' in output
+
+def test_delivery_deadline():
+    routes = prepare_routes({'a': 'https://ya.ru/a',
+                             'b': {'url': 'https://ya.ru/b', 'deadline': 5}})
+    app_config = {'arguments': {MAXAGEARG: 60},
+                  'route_state': {name: {'settings': route}
+                                  for name, route in routes.items()}}
+    assert delivery_deadline(app_config, Delivery('a', 'a', b'', 1)) == 61
+    assert delivery_deadline(app_config, Delivery('b', 'a', b'', 1)) == 6
+    assert delivery_deadline(app_config, Delivery('c', 'a', b'', 1)) == 61
+    app_config['arguments'][MAXAGEARG] = 0
+    assert delivery_deadline(app_config, Delivery('a', 'a', b'', 1)) is None
+
+def test_byte_budget():
+    async def budget():
+        budget = ByteBudget(10)
+        assert budget.take(20)
+        assert budget.full()
+        assert not budget.take(1)
+        waiter = asyncio.create_task(budget.acquire(5))
+        await asyncio.sleep(0)
+        assert not waiter.done()
+        budget.release(20)
+        await waiter
+        assert budget.used == 5
+        assert not budget.full()
+        assert ByteBudget(0).take(100)
+
+    asyncio.run(budget())
+
+@pytest.fixture(scope="function", params=[
+    ({'sentry': None}, True),
+    ({'sentry': {'rules': 'sentry.yml', 'tries': 3, 'autodone': False}}, True),
+    ({'sentry/a': None}, False),
+    ({'sentry': {'tries': -1}}, False),
+    ({'sentry': {'autodone': 1}}, False),
+    ({'sentry': {'unknown': 1}}, False),
+    (['sentry'], False),
+    ])
+def params_check_sources(request):
+    return request.param
+
+def test_check_sources(params_check_sources):
+    (input_data, expected_output) = params_check_sources
+    assert check_sources(input_data) == expected_output
+
+def test_load_config_sources(tmp_path):
+    (tmp_path / 'templates').mkdir()
+    (tmp_path / 'templates' / 'a.j2').write_text('{"a": 1}')
+    (tmp_path / 'routes.yml').write_text('a: https://ya.ru/a\n')
+    (tmp_path / 'rules.yml').write_text(
+        "- name: a\n  when: JSON['a'] == 1\n  template: a.j2\n" +
+        "  routes:\n    - a\n")
+    (tmp_path / 'rules.sentry.yml').write_text(
+        "- name: s\n  when: JSON['s'] == 1\n  template: a.j2\n" +
+        "  routes:\n    - a\n")
+    (tmp_path / 'sources.yml').write_text(
+        'sentry:\n  tries: 3\n  autodone: false\n')
+    arguments = {item['name']: item['default'] for item in ARGSTOPARSE}
+    arguments.update({CONFDIRARG: f'{tmp_path}/', WHENCACHEARG: '',
+                      TEMPLATECACHEARG: ''})
+    config = load_config(arguments, new_cache())
+    assert [rule['name'] for rule in config['rules']] == ['a']
+    sentry = config['sources']['sentry']
+    assert [rule['name'] for rule in sentry['rules']] == ['s']
+    assert sentry['rules'][0]['done'] == False
+    assert sentry['arguments'][TRIESARG] == 3
+
+    app_config = dict(config, queue='events')
+    bind_sources(app_config)
+    assert app_config['sources']['sentry']['queue'] == 'events'
+    assert app_config['sources']['sentry']['source'] == 'sentry'
+
+    (tmp_path / 'sources.yml').write_text('other:\n')
+    assert load_config(arguments, new_cache()) is None
+
+def test_jsoncodec():
+    assert jsoncodec.use('json') == 'json'
+    assert jsoncodec.loads(b'{"a": [1, "b"]}') == {'a': [1, 'b']}
+    assert jsoncodec.loads(jsoncodec.dumps({'a': 'ы'})) == {'a': 'ы'}
+    assert isinstance(jsoncodec.dumps({}), bytes)
+    assert jsoncodec.use('auto') in jsoncodec.BACKENDS
+    for name in jsoncodec.BACKENDS:
+        assert jsoncodec.use(name) == name
+        assert jsoncodec.loads(jsoncodec.dumps({'a': 1})) == {'a': 1}
+    if 'orjson' not in jsoncodec.BACKENDS:
+        assert jsoncodec.use('orjson') == 'json'
+    jsoncodec.use('json')
+    with pytest.raises(ValueError):
+        jsoncodec.loads('broken')
+
+def test_explain_rules(tmp_path):
+    (tmp_path / 'templates').mkdir()
+    (tmp_path / 'templates' / 'a.j2').write_text('{"a": 1}')
+    arguments = {CONFDIRARG: f'{tmp_path}/', DONEARG: True,
+                 WHENBACKENDARG: 'closure', TEMPLATECACHEARG: '',
+                 AUTOESCAPEARG: 'off', UNDEFINEDARG: 'default'}
+    rules = [{'name': 'a', 'headers': {'X-Event': 'push'},
+              'when': "JSON['a']['b'] == 1", 'template': 'a.j2',
+              'routes': ['a']},
+             {'name': 'b', 'when': "JSON['c'] == 2", 'template': 'a.j2',
+              'routes': ['a']},
+             {'name': 'c', 'when': "JSON['c'] == 2", 'template': 'a.j2',
+              'routes': ['a']}]
+    routes = prepare_routes({'a': 'https://ya.ru/a'})
+    rules, templates, index = prepare_rules(rules, routes, arguments,
+                                            new_cache())
+    config = {'rules': rules, 'index': index,
+              'prefilter': headers_prefilter(rules)}
+    explained = explain_rules(config, {'a': {'b': 1}, 'c': 2},
+                              CIMultiDict({'x-event': 'other'}))
+    assert explained['prefilter']
+    assert [(rule['rule'], rule['headers'], rule['when'], rule['matched'],
+             rule['paths']) for rule in explained['rules']] == [
+        ('a', False, None, False, []),
+        ('b', True, True, True, [['c']]),
+        ('c', True, True, False, [['c']])]
+
+def test_rule_profiler():
+    profiler = RuleProfiler(1)
+    profiler.record(None, 'a', 1, 1)
+    profiler.record(None, 'a', 1, 3)
+    profiler.record(None, 'b', 1, 0)
+    assert profiler.table() == [{'source': None, 'rule': 'a', 'samples': 2,
+                                 'headers_seconds': 1, 'when_seconds': 2,
+                                 'mean_seconds': 3, 'max_seconds': 4}]
+
+def test_log_rate_limit():
+    limit = RateLimitFilter(0.001, 2)
+    records = [logging.LogRecord('root', logging.DEBUG, 'a.py', 1,
+                                 'rule %s', (i,), None) for i in range(4)]
+    assert [limit.filter(record) for record in records] == \
+        [True, True, False, False]
+    other = logging.LogRecord('root', logging.DEBUG, 'a.py', 2, 'other',
+                              None, None)
+    assert limit.filter(other)
+    limit.types[('a.py', 1)] = (1, 0, 2)
+    assert limit.filter(records[0])
+    assert records[0].suppressed == 2
+    assert all(RateLimitFilter(0, 1).filter(record) for record in records)
+
+def test_log_truncate():
+    formatter = TruncatingFormatter('%(message)s', 5)
+    record = logging.LogRecord('root', logging.ERROR, 'a.py', 1,
+                               'body %r', (b'0123456789',), None)
+    assert formatter.format(record) == 'body ... [13 more characters]'
+    record = logging.LogRecord('root', logging.ERROR, 'a.py', 1, 'body',
+                               None, None)
+    record.suppressed = 3
+    assert formatter.format(record) == \
+        'body [3 similar messages suppressed]'
+    assert TruncatingFormatter('%(message)s', 0).format(
+        logging.LogRecord('root', logging.ERROR, 'a.py', 1, '0123456789',
+                          None, None)) == '0123456789'
+
+def test_log_background_handler():
+    handler = BackgroundHandler(1)
+    args = ([1], 'a')
+    handler.handle(logging.LogRecord('root', logging.DEBUG, 'a.py', 1,
+                                     'JSON %s %s', args, None))
+    handler.handle(logging.LogRecord('root', logging.DEBUG, 'a.py', 1,
+                                     'JSON %s %s', args, None))
+    record = handler.queue.get_nowait()
+    assert record.args is args and record.getMessage() == 'JSON [1] a'
+    assert handler.dropped == 1
+    handler.handle(logging.LogRecord('root', logging.DEBUG, 'a.py', 1,
+                                     'next', None, None))
+    assert handler.queue.get_nowait().dropped == 1
+    assert handler.dropped == 0
+
+class BodyRequest:
+    def __init__(self, body, encoding=None, chunk=4):
+        self.headers = CIMultiDict()
+        if encoding is not None:
+            self.headers['Content-Encoding'] = encoding
+        self.body = body
+        self.content = self
+        self.chunk = chunk
+
+    async def read(self):
+        return(self.body)
+
+    async def iter_chunked(self, size):
+        for i in range(0, len(self.body), self.chunk):
+            yield(self.body[i:i + self.chunk])
+
+@pytest.fixture(scope="function", params=[
+    (BodyRequest(b'{"a": 1}'), b'{"a": 1}'),
+    (BodyRequest(gzip.compress(b'{"a": 1}'), 'gzip'), b'{"a": 1}'),
+    (BodyRequest(zlib.compress(b'{"a": 1}'), 'Deflate'), b'{"a": 1}'),
+    (BodyRequest(gzip.compress(b'0' * 1000), 'gzip'),
+     web.HTTPRequestEntityTooLarge),
+    (BodyRequest(gzip.compress(b'0' * 10000), 'gzip', 1000),
+     web.HTTPRequestEntityTooLarge),
+    (BodyRequest(gzip.compress(b'{}')[:-10], 'gzip'), web.HTTPBadRequest),
+    (BodyRequest(b'{}', 'gzip'), web.HTTPBadRequest),
+    (BodyRequest(b'{}', 'br'), web.HTTPUnsupportedMediaType),
+    ])
+def params_read_body(request):
+    return request.param
+
+def test_read_body(params_read_body):
+    (input_data, expected_output) = params_read_body
+    if isinstance(expected_output, bytes):
+        assert asyncio.run(read_body(input_data, 100, 100)) == expected_output
+    else:
+        with pytest.raises(expected_output):
+            asyncio.run(read_body(input_data, 100, 100))
+
+def test_compress_deliveries():
+    rule = {'name': 'a', 'routes': ['plain', 'small', 'gzip', 'gzip2']}
+    body = b'{"a": "' + b'0' * 100 + b'"}'
+
+    async def deliveries():
+        app_config = {'source': None,
+                      'arguments': {OVERFLOWARG: 'reject'},
+                      'queue': None,
+                      'route_state': {},
+                      'budget': ByteBudget(0),
+                      'metrics': None}
+        for name, compress in (('plain', 0), ('small', 1000), ('gzip', 10),
+                               ('gzip2', 100)):
+            app_config['route_state'].update({name: {
+                'queue': asyncio.Queue(),
+                'settings': dict(ROUTEDEFAULTS, compress=compress)}})
+        await queue_deliveries(app_config, rule, body)
+        return([state['queue'].get_nowait()
+                for state in app_config['route_state'].values()])
+
+    plain, small, compressed, compressed2 = asyncio.run(deliveries())
+    assert (plain.body, plain.encoding) == (body, None)
+    assert (small.body, small.encoding) == (body, None)
+    assert compressed.encoding == 'gzip'
+    assert gzip.decompress(compressed.body) == body
+    assert compressed2.body is compressed.body
+
+def test_scale_route():
+    async def scale():
+        app_config = {'arguments': {ROUTEQUEUEARG: 10, ROUTEWORKERSARG: 3},
+                      'route_state': {},
+                      'metrics': None}
+        start_route(app_config, 'a', dict(ROUTEDEFAULTS,
+                                          url='http://127.0.0.1:1/a'))
+        state = app_config['route_state']['a']
+        await asyncio.sleep(0)
+# workers are not cancelled on scale down, they retire after delivery
+        state['settings'] = dict(state['settings'], workers=1)
+        scale_route(app_config, 'a')
+        await asyncio.sleep(0)
+        result = (len(state['tasks']), state['retire'],
+                  any(task.done() for task in state['tasks']))
+        state['settings'] = dict(state['settings'], workers=4)
+        scale_route(app_config, 'a')
+        result += (len(state['tasks']), state['retire'])
+        await stop_route(state)
+        return(result)
+
+    assert asyncio.run(scale()) == (3, 2, False, 4, 0)
+
+def test_stop_routes_journal(tmp_path):
+    path = str(tmp_path / 'journal.sqlite')
+
+    async def stop():
+        app_config = {'arguments': {ROUTEQUEUEARG: 10, ROUTEWORKERSARG: 1},
+                      'route_state': {},
+                      'metrics': None,
+                      'scheduler': RetryScheduler(Journal(path), None)}
+        await app_config['scheduler'].start()
+        start_route(app_config, 'a', dict(ROUTEDEFAULTS,
+                                          url='http://127.0.0.1:1/a'))
+        state = app_config['route_state']['a']
+        await asyncio.sleep(0)
+        for task in state['tasks']:
+            task.cancel()
+        state['queue'].put_nowait(Delivery('a', 'b', b'{}', 1.0))
+        state['queue'].put_nowait(Delivery('a', 'c', b'{}', 1.0))
+        await stop_routes({'config': {'app_config': app_config}})
+        pending = await app_config['scheduler'].journal.open()
+        await app_config['scheduler'].journal.close()
+        return(len(pending), app_config['route_state'])
+
+    assert asyncio.run(stop()) == (2, {})
+
+def test_orphan_journals(tmp_path):
+    path = str(tmp_path / 'journal.sqlite')
+    for name in ('journal.sqlite', 'journal.0.sqlite', 'journal.2.sqlite',
+                 'journal.sqlite-wal', 'journal.x.sqlite'):
+        (tmp_path / name).write_bytes(b'')
+    assert orphan_journals(path, None, 1) == [
+        str(tmp_path / 'journal.0.sqlite'), str(tmp_path / 'journal.2.sqlite')]
+    assert orphan_journals(path, 0, 2) == [
+        str(tmp_path / 'journal.2.sqlite'), path]
+
+def test_journal_adopt(tmp_path):
+    path = str(tmp_path / 'journal.sqlite')
+    orphan = str(tmp_path / 'journal.1.sqlite')
+    delivery = Delivery('a', 'b', b'{}', 1.0, 1, source='s')
+
+    async def adopt():
+        other = Journal(orphan)
+        await other.open()
+        await other.save(delivery, 2.0)
+        await other.close()
+        journal = Journal(path)
+        adopted = await journal.adopt(orphan)
+        pending = await journal.open()
+        loaded = await journal.load(pending[0][1])
+        await journal.close()
+        return(adopted, pending[0][0], loaded)
+
+    adopted, due, loaded = asyncio.run(adopt())
+    assert (adopted, due) == (1, 2.0)
+    assert (loaded.rule, loaded.source, loaded.attempts) == ('b', 's', 1)
+    assert not os.path.exists(orphan)
+
+def test_route_deadline_after_pause():
+    async def pause():
+        app_config = {'arguments': {ROUTEQUEUEARG: 10, ROUTEWORKERSARG: 1,
+                                    MAXAGEARG: 0},
+                      'route_state': {},
+                      'source_state': {},
+                      'queue': None,
+                      'budget': ByteBudget(0),
+                      'scheduler': None}
+        app_config['metrics'] = prepare_metrics(app_config)
+        start_route(app_config, 'a', dict(ROUTEDEFAULTS, deadline=0.1,
+                                          url='http://127.0.0.1:1/a'))
+        state = app_config['route_state']['a']
+        state['bucket'].pause(0.3)
+        app_config['budget'].take(2)
+        state['queue'].put_nowait(Delivery('a', 'b', b'{}', time.time()))
+        await asyncio.sleep(0.5)
+        await stop_route(state)
+        metrics = app_config['metrics']
+        return(metrics['route_expired'].values,
+               metrics['route_attempts'].values, app_config['budget'].used)
+
+    assert asyncio.run(pause()) == ({('a',): 1}, {}, 0)
+
+def test_prefilter_skips_body_read():
+    class UnreadRequest(BodyRequest):
+        async def read(self):
+            raise AssertionError('body is read')
+
+        async def iter_chunked(self, size):
+            raise AssertionError('body is read')
+            yield(b'')
+
+    request = UnreadRequest(b'{"a": 1}')
+    request.headers['X-Event'] = 'other'
+    request.match_info = {}
+    app_config = {'source': None, 'queue': None, 'route_state': {},
+                  'source_state': {}, 'capture': None,
+                  'budget': ByteBudget(0),
+                  'prefilter': [{'X-Event': 'push'}],
+                  'arguments': {MAXBODYARG: 100, MAXDECOMPRESSEDARG: 100}}
+    app_config['metrics'] = prepare_metrics(app_config)
+    request.app = {'config': {'app_config': app_config}}
+    with pytest.raises(web.HTTPOk):
+        asyncio.run(receive_handler(request))
+    assert app_config['metrics']['skipped'].values == {('headers',): 1}
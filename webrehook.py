@@ -5,18 +5,47 @@ import re
 import yaml
 import logging
 import sys
-import json
 import validators
 import py_compile
 import os
+import time
+import hashlib
+import hmac
+import importlib.util
+import marshal
+import signal
+import collections
+import random
+import shutil
+import tempfile
+import glob
+import sqlite3
+import zlib
+import gzip
 import asyncio
 import jinja2
 import aiohttp
 import sly
+import jsoncodec
 from aiohttp import web, ClientSession
-from whenparse import WhenLexer, WhenParser
+from whenparse import WhenLexer, WhenParser, equality_predicates, \
+                      compile_closure, path_accessor
 from sly.yacc import GrammarError
 from sly.lex import LexError
+# uvloop is optional, see --loop
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+from journal import Delivery, Journal, RetryScheduler, retry_delay
+from limits import ByteBudget, CircuitBreaker, TokenBucket, \
+    parse_retry_after
+from metrics import Registry
+from dedup import DedupCache, event_key
+from capture import Capture
+from logqueue import setup_logging, stop_logging
+from profiler import RuleProfiler
+from multidict import CIMultiDict
 
 def load_yml(file):
     with open(file, 'r') as f:
@@ -26,13 +55,13 @@ def load_yml(file):
             logging.error(f'load_yml: Broken yml format in {file}. Exiting.')
             return(False)
         except:
-            logging.error('load_yml: Unexpected yml error:', sys.exc_info()[0])
+            logging.exception('load_yml: Unexpected yml error')
             return(False)
 
     return(yml)
 
 def parse_when(when):
-    lexer = WhenLexer()
+    lexer = WHENLEXER
     try:
         tokens = lexer.tokenize(when)
     except LexError:
@@ -40,11 +69,10 @@ def parse_when(when):
             f'parse_when: Unable to lex {when}. Exiting.')
         return(None)
     except:
-        logging.error(
-            'parse_when: Lex unexpected error:', sys.exc_info()[0])
+        logging.exception('parse_when: Lex unexpected error')
         return(None)
 
-    parser = WhenParser()
+    parser = WHENPARSER
     try:
         result = parser.parse(tokens)
     except GrammarError:
@@ -52,8 +80,7 @@ def parse_when(when):
             f'parse_when: Unable to parse {when}. Exiting.')
         return(None)
     except:
-        logging.error(
-            'parse_when: Parse unexpected error:', sys.exc_info()[0])
+        logging.exception('parse_when: Parse unexpected error')
         return(None)
     return(result)
 
@@ -84,80 +111,277 @@ def json_query_recursive(JSON, json_items):
             f'json_query_recussive: Type error in {json_items}. Exiting.')
         return(None)
     except:
-        logging.error(
-            'json_query_recussive: JSON unexpected error:', sys.exc_info()[0])
+        logging.exception('json_query_recussive: JSON unexpected error')
         return(None)
 
     return(obj)
 
-def prepare_rules(rules, routes, arguments):
-    template_path = f"{arguments[CONFDIRARG]}templates/"
+def index_keys(rule, json_predicates):
+    keys = [('headers', key, value)
+            for key, value in (rule.get('headers') or {}).items()]
+    keys += [('json', path, value) for path, value in json_predicates]
+    hashable = []
+    for key in keys:
+        try:
+            hash(key)
+        except TypeError:
+            continue
+        hashable.append(key)
+    return(hashable)
+
+def index_rules(rules, predicates, accessors):
+# every rule is put to one bucket: either by exact value of one of its
+# headers, or by literal of JSON[...] == literal test from its when, or to
+# always evaluated list. Key shared by less rules is preferred.
+    index = {'headers': {}, 'json': {}, 'accessors': {}, 'always': []}
+    counts = {}
+    for rule, json_predicates in zip(rules, predicates):
+        for key in index_keys(rule, json_predicates):
+            counts.update({key: counts.get(key, 0) + 1})
+
+    for i, (rule, json_predicates) in enumerate(zip(rules, predicates)):
+        keys = index_keys(rule, json_predicates)
+        if not keys:
+            index['always'].append(i)
+            continue
+        kind, key, value = min(keys, key=lambda key: counts[key])
+        buckets = index[kind].setdefault(key, {})
+        buckets.setdefault(value, []).append(i)
+        if kind == 'json':
+            index['accessors'].update({key: path_accessor(key, accessors)})
+
+    return(index)
+
+def candidate_rules(index, JSON, headers, memo):
+    candidates = list(index['always'])
+    for key, buckets in index['headers'].items():
+        value = headers.get(key)
+        if value is not None:
+            candidates.extend(buckets.get(value, ()))
+    for path, buckets in index['json'].items():
+        value = index['accessors'][path](JSON, memo)
+        try:
+            candidates.extend(buckets.get(value, ()))
+        except TypeError:
+            continue
+    candidates.sort()
+    return(candidates)
+
+def eval_when(code):
+    def when(JSON, memo):
+        return(eval(code, WHENNAMES, {'JSON': JSON}))
+    return(when)
+
+def template_stamps(template_path):
+    stamps = {}
+    for root, dirs, files in os.walk(template_path):
+        for name in files:
+            try:
+                stat = os.stat(os.path.join(root, name))
+            except OSError:
+                continue
+            stamps.update({os.path.join(root, name):
+                           (stat.st_mtime_ns, stat.st_size)})
+    return(stamps)
+
+def template_environment(template_path, arguments, cache):
+# all templates share one environment, so they may include or import each
+# other. Environment is recreated only when some file in templates dir or
+# settings change, otherwise compiled templates are reused between reloads
+    settings = (template_path, arguments[TEMPLATECACHEARG],
+                arguments[AUTOESCAPEARG], arguments[UNDEFINEDARG])
+    stamps = template_stamps(template_path)
+    cached = cache['environment'].get(template_path)
+    if cached is not None and cached[:2] == (settings, stamps):
+        return(cached[2])
+
+    bytecode_cache = None
+    if arguments[TEMPLATECACHEARG]:
+        directory = arguments[CONFDIRARG] + arguments[TEMPLATECACHEARG]
+        try:
+            os.makedirs(directory, exist_ok=True)
+            bytecode_cache = jinja2.FileSystemBytecodeCache(directory)
+        except OSError:
+            logging.warning(
+                f'template_environment: Unable to use {directory}')
+    autoescape = arguments[AUTOESCAPEARG] == 'on'
+    if arguments[AUTOESCAPEARG] == 'html':
+        autoescape = jinja2.select_autoescape()
+    environment = jinja2.Environment(
+        loader=jinja2.FileSystemLoader(template_path),
+        bytecode_cache=bytecode_cache,
+        autoescape=autoescape,
+        undefined=UNDEFINEDPOLICIES[arguments[UNDEFINEDARG]],
+        auto_reload=False)
+    cache['environment'].update(
+        {template_path: (settings, stamps, environment)})
+    return(environment)
+
+def load_template(name, environment, templates, rule_name):
+# templates are compiled on first use, so files not used by any rule are
+# never compiled
+    if name in templates.keys():
+        return(True)
+
+    try:
+        j2template = environment.get_template(name)
+    except jinja2.TemplateNotFound:
+        logging.error(
+            f'load_template: Something wrong with {name}. Exiting.')
+        return(False)
+    except jinja2.TemplateError:
+        logging.error(
+            f"load_template: Jinja template error in {rule_name}. Exiting.")
+        return(False)
+    templates.update({name: j2template})
+    return(True)
+
+def new_cache():
+# when: (prepared when, predicates, parsed entry) by (when source, backend),
+# environment: (settings, templates stamps, jinja environment) by templates
+# dir, parsed: (when, parsed source, predicates, code) by when hash, loaded
+# from disk, used: parsed entries of last prepared rules to save to disk
+    return({'when': {}, 'environment': {}, 'parsed': {}, 'used': {}})
+
+def when_hash(when):
+    return(hashlib.sha256(when.encode('utf-8')).hexdigest())
+
+def load_when_cache(path):
+    try:
+        with open(path, 'rb') as f:
+            header = f.read(len(WHENCACHEHEADER))
+            if header != WHENCACHEHEADER:
+                logging.info(f'load_when_cache: {path} is outdated')
+                return({})
+            parsed = marshal.load(f)
+    except FileNotFoundError:
+        return({})
+    except (OSError, EOFError, ValueError, TypeError):
+        logging.warning(f'load_when_cache: Broken {path}. Ignoring.')
+        return({})
+    if not isinstance(parsed, dict):
+        return({})
+    return(parsed)
+
+def save_when_cache(path, parsed):
+    try:
+        with open(path + '.tmp', 'wb') as f:
+            f.write(WHENCACHEHEADER)
+            marshal.dump(parsed, f)
+        os.replace(path + '.tmp', path)
+    except OSError:
+        logging.warning(f'save_when_cache: Unable to write {path}')
+
+def compile_when(when, name, cache):
+# returns (when, parsed source, predicates, code), from disk cache if possible
+    parsed = cache['parsed'].get(when_hash(when))
+    if parsed is not None and parsed[0] == when:
+        return(parsed)
+
+    parsed_when = parse_when(when)
+    if parsed_when is None:
+        return(None)
+    try:
+        code = compile((parsed_when), 'string', 'eval')
+    except SyntaxError:
+        logging.error(
+        f"compile_when: Syntax error in \"{name}\". Exiting.")
+        return(None)
+    except py_compile.PyCompileError:
+        logging.error(
+        f"compile_when: Compile error in \"{name}\". Exiting.")
+        return(None)
+    except:
+        logging.exception(f"compile_when: Unexpected compile error in {when}")
+        return(None)
+
+    return((when, parsed_when, equality_predicates(parsed_when), code))
+
+def prepare_rules(rules, routes, arguments, cache, template_path=None):
+    if template_path is None:
+        template_path = f"{arguments[CONFDIRARG]}templates/"
+    environment = template_environment(template_path, arguments, cache)
     done = arguments[DONEARG]
+    backend = arguments[WHENBACKENDARG]
     templates = {}
+    predicates = []
+    accessors = {}
 
     for rule in rules:
         if rule.get('name') is None:
             logging.error(
                 f"prepare_rules: Missed name field in {rule}. Exiting")
-            return(False, False)
+            return(False, False, False)
 
         if rule.get('headers') is not None and \
                 not isinstance(rule['headers'], dict):
             logging.error(
                 f"prepare_rules: Wrong headers in \"{rule['name']}\". Exiting")
-            return(False, False)
+            return(False, False, False)
 
-        if rule.get('when') is not None:
-            parsed_when = parse_when(rule['when'])
-            if parsed_when is None:
-                return(False, False)
-            try:
-                code = compile((parsed_when), 'string', 'eval')
-            except SyntaxError:
-                logging.error(
+        cached = None
+        if isinstance(rule.get('when'), str):
+            cached = cache['when'].get((rule['when'], backend))
+        if cached is not None:
+            predicates.append(cached[1])
+            cache['used'].update({when_hash(rule['when']): cached[2]})
+            rule.update({'when': cached[0]})
+        elif rule.get('when') is not None:
+            source = rule['when']
+            compiled = compile_when(source, rule['name'], cache)
+            if compiled is None:
+                return(False, False, False)
+            cache['used'].update({when_hash(source): compiled})
+            parsed_when, when_predicates, code = compiled[1:]
+            predicates.append(when_predicates)
+            if backend == 'eval':
+                rule.update({'when': eval_when(code)})
+            else:
+                try:
+                    when = compile_closure(parsed_when, accessors, WHENNAMES)
+                except SyntaxError:
+                    logging.error(
                 f"prepare_rules: Syntax error in \"{rule['name']}\". Exiting.")
-                return(False, False)
-            except py_compile.PyCompileError:
-                logging.error(
-                f"prepare_rules: Compile error in \"{rule['name']}\". Exiting.")
-                return(False, False)
-            except:
-                logging.error(
-                "prepare_rules: Unexpected compile error in {rule['when']}:",
-                              sys.exc_info()[0])
-                return(False, False)
-            rule.update({'when': code})
+                    return(False, False, False)
+                rule.update({'when': when})
+            cache['when'].update(
+                {(source, backend): (rule['when'], predicates[-1], compiled)})
+        else:
+            predicates.append([])
 
         if rule.get('routes') is not None:
             for route in rule['routes']:
                 if route not in routes.keys():
                     logging.error(
                     f'prepare_rules: {route} is absent in routes.yml. Exiting.')
-                    return(False, False)
+                    return(False, False, False)
         else:
             logging.error(
                 f'prepare_rules: Route is not set for {rule["name"]}. Exiting.')
-            return(False, False)
+            return(False, False, False)
 
         if rule.get('template'):
-            if rule['template'] not in templates.keys():
-                path = template_path + rule['template']
-                if not os.path.isfile(path) or not os.access(path, os.R_OK):
-                    logging.error(
-                        f'prepare_rules: Something wrong with {path}. Exiting.')
-                    return(False, False)
-                with open(path, 'r') as f:
-                    try:
-                        j2template = jinja2.Template(f.read())
-                    except jinja2.TemplateError:
-                        logging.error(
-             f"prepare_rules: Jinja template error in {rule['name']}. Exiting.")
-                        return(False, False)
-                    templates.update({rule['template']: j2template})
+            if not load_template(rule['template'], environment, templates,
+                                 rule['name']):
+                return(False, False, False)
         else:
             logging.error(
             f'prepare_rules: Template is not set for {rule["name"]}. Exiting.')
-            return(False, False)
+            return(False, False, False)
+
+        if rule.get('batch') is not None:
+            batch = rule['batch']
+            if not isinstance(batch, dict) or \
+                    not isinstance(batch.get('events'), int) or \
+                    not isinstance(batch.get('ms'), int) or \
+                    batch['events'] < 1 or batch['ms'] < 1:
+                logging.error(
+                    f'prepare_rules: Wrong batch in {rule["name"]}. Exiting.')
+                return(False, False, False)
+            batch.setdefault('template', rule['template'])
+            if not load_template(batch['template'], environment, templates,
+                                 rule['name']):
+                return(False, False, False)
 
         if rule.get('done') is None:
             rule.update({'done': done})
@@ -165,120 +389,1218 @@ def prepare_rules(rules, routes, arguments):
             if rule['done'] not in [True, False]:
                 logging.error(
                     f'prepare_rules: Wrong done in {rule["name"]}. Exiting.')
-                return(False, False)
+                return(False, False, False)
 
-    return(rules, templates)
+    return(rules, templates, index_rules(rules, predicates, accessors))
 
 def check_routes(routes):
     for key, value in routes.items():
-        if not validators.url(value):
+        if isinstance(value, dict):
+            url = value.get('url')
+            for setting in value.keys():
+                if setting == 'url':
+                    continue
+                if setting not in ROUTEDEFAULTS.keys():
+                    logging.error(
+                f'check_routes: Unknown {setting} in {key} route. Exiting.')
+                    return(False)
+                if not isinstance(value[setting], (int, float)) or \
+                        isinstance(value[setting], bool) or \
+                        value[setting] < 0:
+                    logging.error(
+                f'check_routes: Wrong {setting} in {key} route. Exiting.')
+                    return(False)
+        else:
+            url = value
+        if not isinstance(url, str) or not validators.url(url):
             logging.error(
-                f'check_routes: {key, value} url validation failed. Exiting.')
+                f'check_routes: {key, url} url validation failed. Exiting.')
+            return(False)
+    return(True)
+
+def check_sources(sources):
+    if not isinstance(sources, dict):
+        logging.error('check_sources: Wrong sources.yml format. Exiting.')
+        return(False)
+    for key, value in sources.items():
+        if not isinstance(key, str) or not SOURCENAME.match(key):
+            logging.error(f'check_sources: Wrong source name {key}. Exiting.')
+            return(False)
+        if value is None:
+            continue
+        if not isinstance(value, dict):
+            logging.error(f'check_sources: Wrong {key} source. Exiting.')
             return(False)
+        for setting in value.keys():
+            if setting not in SOURCEDEFAULTS.keys():
+                logging.error(
+                f'check_sources: Unknown {setting} in {key} source. Exiting.')
+                return(False)
+            if setting in ('rules', 'templates'):
+                valid = isinstance(value[setting], str)
+            elif setting == 'autodone':
+                valid = isinstance(value[setting], bool)
+            else:
+                valid = isinstance(value[setting], int) and \
+                    not isinstance(value[setting], bool) and \
+                    value[setting] >= 0
+            if not valid:
+                logging.error(
+                f'check_sources: Wrong {setting} in {key} source. Exiting.')
+                return(False)
     return(True)
 
+def prepare_sources(sources):
+    prepared = {}
+    for key, value in sources.items():
+        source = dict(SOURCEDEFAULTS)
+        source.update(value or {})
+        if not source['rules']:
+            source.update({'rules': f'rules.{key}.yml'})
+        if not source['templates'].endswith('/'):
+            source.update({'templates': source['templates'] + '/'})
+        prepared.update({key: source})
+    return(prepared)
+
+def load_source(name, source, routes, arguments, cache):
+# returns rules partition of source with its own arguments or None
+    arguments = dict(arguments)
+    if source['autodone'] is not None:
+        arguments.update({DONEARG: source['autodone']})
+    for setting, arg in SOURCEARGS.items():
+        if source[setting]:
+            arguments.update({arg: source[setting]})
+
+    path = arguments[CONFDIRARG] + source['rules']
+    if not os.path.isfile(path):
+        logging.error(f'load_source: No {path} for {name} source. Exiting.')
+        return(None)
+    rules = load_yml(path)
+    if rules == False:
+        return(None)
+
+    rules, templates, index = prepare_rules(rules, routes, arguments, cache,
+        arguments[CONFDIRARG] + source['templates'])
+    if False in (rules, templates, index):
+        return(None)
+
+    return({'source': name,
+            'arguments': arguments,
+            'rules': rules,
+            'templates': templates,
+            'index': index,
+            'prefilter': headers_prefilter(rules),
+            'batches': {}})
+
+def prepare_routes(routes):
+    prepared = {}
+    for key, value in routes.items():
+        route = dict(ROUTEDEFAULTS)
+        if isinstance(value, dict):
+            route.update(value)
+        else:
+            route.update({'url': value})
+        prepared.update({key: route})
+    return(prepared)
+
+def route_session(route):
+    connector = aiohttp.TCPConnector(
+        limit=route['limit'],
+        limit_per_host=route['limit_per_host'],
+        keepalive_timeout=route['keepalive'],
+        use_dns_cache=route['dns_ttl'] > 0,
+        ttl_dns_cache=route['dns_ttl'])
+    timeout = aiohttp.ClientTimeout(total=route['timeout'] or None,
+                                    connect=route['connect_timeout'] or None,
+                                    sock_read=route['read_timeout'] or None)
+    return(ClientSession(connector=connector, timeout=timeout))
+
+def delivery_deadline(app_config, delivery):
+# returns time after which delivery is abandoned or None
+    state = app_config['route_state'].get(delivery.route)
+    max_age = app_config['arguments'][MAXAGEARG]
+    if state is not None and state['settings']['deadline']:
+        max_age = state['settings']['deadline']
+    if not max_age:
+        return(None)
+    return(delivery.created + max_age)
+
+async def expire_delivery(app_config, delivery):
+    logging.warning('expire_delivery: "%s" delivery to %s missed deadline ' +
+                    'after %d attempts. Dropped.', delivery.rule,
+                    delivery.route, delivery.attempts)
+    app_config['metrics']['route_dropped'].inc((delivery.route,))
+    app_config['metrics']['route_expired'].inc((delivery.route,))
+    if delivery.id is not None:
+        await app_config['scheduler'].journal.remove(delivery.id)
+
+def start_route(app_config, name, route):
+# route state is shared by all config snapshots, so it is updated in place
+    arguments = app_config['arguments']
+    size = route['queue'] or arguments[ROUTEQUEUEARG]
+    state = {'settings': route,
+             'session': route_session(route),
+             'queue': asyncio.Queue(maxsize=size),
+             'breaker': CircuitBreaker(name, route['breaker_failures'],
+                                       route['breaker_reset']),
+             'bucket': TokenBucket(route['rate'], route['burst']),
+             'tasks': [],
+             'retire': 0,
+             'interrupted': []}
+    app_config['route_state'].update({name: state})
+    scale_route(app_config, name)
+
+def scale_route(app_config, name):
+# extra workers are not cancelled, they retire after current delivery
+    state = app_config['route_state'][name]
+    workers = state['settings']['workers'] or \
+        app_config['arguments'][ROUTEWORKERSARG]
+    tasks = state['tasks']
+    state['retire'] = max(len(tasks) - workers, 0)
+    while len(tasks) < workers:
+        tasks.append(asyncio.create_task(route_worker(app_config, name)))
+
+async def update_routes(app_config, routes):
+# applies reloaded routes: removed ones are drained and stopped, changed
+# ones get new session and limits, pending deliveries stay in their queues
+    route_state = app_config['route_state']
+    for name in list(route_state.keys()):
+        if name not in routes:
+            state = route_state.pop(name)
+            start_background(app_config, stop_route(state, drain=True))
+
+    for name, route in routes.items():
+        state = route_state.get(name)
+        if state is None:
+            start_route(app_config, name, route)
+            continue
+        if state['settings'] == route:
+            continue
+        if state['settings']['queue'] != route['queue']:
+            logging.warning(f'update_routes: {name} queue size is changed ' +
+                            'on restart only')
+        start_background(app_config,
+                         close_session(state['session'], SESSIONGRACE))
+        state.update({
+            'settings': route,
+            'session': route_session(route),
+            'breaker': CircuitBreaker(name, route['breaker_failures'],
+                                      route['breaker_reset']),
+            'bucket': TokenBucket(route['rate'], route['burst'])})
+        scale_route(app_config, name)
+
+async def close_session(session, delay):
+    try:
+        await asyncio.sleep(delay)
+    finally:
+        await session.close()
+
+async def stop_route(state, drain=False):
+    if drain:
+        await state['queue'].join()
+    for task in state['tasks']:
+        task.cancel()
+    await asyncio.gather(*state['tasks'], return_exceptions=True)
+    await state['session'].close()
+
+async def start_routes(app):
+    app_config = app['config']['app_config']
+    for name, route in app_config['routes'].items():
+        start_route(app_config, name, route)
+
+async def stop_routes(app):
+# deliveries left in route queues or interrupted by stop are journaled to
+# be sent after restart
+    app_config = app['config']['app_config']
+    route_state = app_config['route_state']
+    for state in route_state.values():
+        await stop_route(state)
+    pending = []
+    for state in route_state.values():
+        pending.extend(state['interrupted'])
+        while not state['queue'].empty():
+            pending.append(state['queue'].get_nowait())
+    if pending and app_config['scheduler'] is not None:
+        await app_config['scheduler'].journal.save_all(pending, time.time())
+        logging.info('stop_routes: %d deliveries journaled', len(pending))
+    route_state.clear()
+
+def headers_prefilter(rules):
+# returns unique headers sets of all rules, None when some rule has no
+# headers and so any request may match
+    prefilter = {}
+    for rule in rules:
+        headers = rule.get('headers')
+        if not headers:
+            return(None)
+        try:
+            prefilter.update({frozenset(headers.items()): headers})
+        except TypeError:
+            return(None)
+    return(list(prefilter.values()))
+
+def headers_match(prefilter, headers):
+    if prefilter is None:
+        return(True)
+    for rule_headers in prefilter:
+        for key, value in rule_headers.items():
+            if headers.get(key) != value:
+                break
+        else:
+            return(True)
+    return(False)
+
+async def read_body(request, max_body, max_decompressed):
+# returns request body decoded by Content-Encoding. Compressed body is read
+# and inflated by chunks, each inflate step is bounded by bytes left to
+# max_decompressed, so small compressed body never expands beyond it
+    encoding = request.headers.get('Content-Encoding', 'identity')
+    encoding = encoding.strip().lower()
+    if encoding not in CONTENTENCODINGS:
+        raise web.HTTPUnsupportedMediaType
+    wbits = CONTENTENCODINGS[encoding]
+    if wbits is None:
+        return(await request.read())
+
+    decompressor = zlib.decompressobj(wbits)
+    chunks = []
+    received = 0
+    size = 0
+    try:
+        async for chunk in request.content.iter_chunked(READCHUNK):
+            received += len(chunk)
+            if received > max_body:
+                raise web.HTTPRequestEntityTooLarge(max_size=max_body,
+                                                    actual_size=received)
+            while chunk and not decompressor.eof:
+                data = decompressor.decompress(chunk,
+                                               max_decompressed - size + 1)
+                size += len(data)
+                if size > max_decompressed:
+                    raise web.HTTPRequestEntityTooLarge(
+                        max_size=max_decompressed, actual_size=size)
+                chunks.append(data)
+                chunk = decompressor.unconsumed_tail
+    except zlib.error:
+        raise web.HTTPBadRequest
+    if not decompressor.eof:
+        raise web.HTTPBadRequest
+    return(b''.join(chunks))
+
+def capture_skipped(app_config, headers, body):
+# request not passed to rules is captured with no matched rules
+    if body is not None and not app_config['capture'].put(
+            headers, body, [], app_config['source']):
+        app_config['metrics']['capture_dropped'].inc()
+
+async def receive_body(app_config, request):
+    try:
+        return(await read_body(request, app_config['arguments'][MAXBODYARG],
+                               app_config['arguments'][MAXDECOMPRESSEDARG]))
+    except web.HTTPClientError:
+        app_config['metrics']['skipped'].inc(('body',))
+        raise
+
 async def receive_handler(request):
-    text = await request.text()
-    none = None
+    started = time.perf_counter()
+    app_config = request.app['config']['app_config']
+    queue = app_config['queue']
+    source = request.match_info.get('source')
+    if source is not None:
+        if source not in app_config['sources']:
+            raise web.HTTPNotFound
+        queue = app_config['source_state'][source]['queue']
+        app_config = app_config['sources'][source]
+    metrics = app_config['metrics']
+    headers = request.headers
+    metrics['received'].inc()
+# raw ingest stream is captured, skipped requests with no matched rules, so
+# only sampled requests are read before checks not needing body
+    body = captured = None
+    if app_config['capture'] is not None and \
+            random.random() < app_config['arguments'][CAPTURESAMPLEARG]:
+        body = captured = await receive_body(app_config, request)
+
+    if not headers_match(app_config['prefilter'], headers):
+        logging.debug('receive_handler: No rule matches headers. Skipping.')
+        metrics['skipped'].inc(('headers',))
+        capture_skipped(app_config, headers, captured)
+        raise web.HTTPOk
+    if app_config['budget'].full() and \
+            app_config['arguments'][OVERFLOWARG] == 'reject':
+        logging.warning(
+            'receive_handler: In-flight bytes limit is reached. Rejecting.')
+        metrics['skipped'].inc(('inflight_bytes',))
+        capture_skipped(app_config, headers, captured)
+        raise web.HTTPTooManyRequests
+
+    if body is None:
+        body = await receive_body(app_config, request)
+    key = None
+    if app_config['dedup'] is not None:
+        key = event_key(headers, body,
+                        app_config['arguments'][DEDUPHEADERARG],
+                        app_config['arguments'][DEDUPHASHARG])
+# dedup cache is shared by sources, so the same event may come to each
+        if key is not None:
+            key = (app_config['source'], key)
+        if key is not None and not app_config['dedup'].add(key):
+            logging.debug('receive_handler: Duplicate event. Skipping.')
+            metrics['skipped'].inc(('duplicate',))
+            capture_skipped(app_config, headers, captured)
+            raise web.HTTPOk
+
+    decode_started = time.perf_counter()
     try:
-        json_received = json.loads(text)
+        json_received = jsoncodec.loads(body)
     except ValueError:
-        logging.error(f'receive_handler: ValueError: {text}')
-        raise web.HTTPOk
-    except json.decoder.JSONDecodeError:
-        logging.error(f'receive_handler: JSONDecodeError: {text}')
+        logging.error('receive_handler: ValueError: %r',
+                      body[:app_config['arguments'][LOGTRUNCATEARG] or None])
+        metrics['skipped'].inc(('decode',))
+        capture_skipped(app_config, headers, captured)
         raise web.HTTPOk
     except:
-        logging.error("receive_handler: JSON Unexpected error:",
-                     sys.exc_info()[0])
+        logging.exception("receive_handler: JSON Unexpected error")
+        metrics['skipped'].inc(('decode',))
+        capture_skipped(app_config, headers, captured)
         raise web.HTTPOk
+    metrics['stage'].observe(time.perf_counter() - decode_started, ('decode',))
 
-    app_config = request.app['app_config']
-    headers = request.headers
-    asyncio.create_task(process_rules(app_config, json_received, headers))
+    queued = await put_queue(queue,
+                             (app_config, json_received, headers, captured),
+                             app_config['arguments'][OVERFLOWARG])
+    if not queued:
+        if key is not None:
+            app_config['dedup'].remove(key)
+        logging.warning('receive_handler: Event queue is full. Rejecting.')
+        metrics['skipped'].inc(('queue_full',))
+        capture_skipped(app_config, headers, captured)
+        raise web.HTTPTooManyRequests
 
+    metrics['stage'].observe(time.perf_counter() - started, ('ingest',))
     raise web.HTTPOk
 
-async def send_handler(JSON, url, name, template, arguments):
-    text = template.render(JSON = JSON)
+async def metrics_handler(request):
+    app_config = request.app['config']['app_config']
+    registry = app_config['metrics']['registry']
+    if app_config['metrics_dir'] is None:
+        return(web.Response(text=registry.render(), content_type='text/plain'))
+
+# sum metrics of all workers, own ones are taken live
+    merged = registry.copy()
+    merged.merge(registry.snapshot())
+    own = f"{app_config['worker']}.json"
+    for name in os.listdir(app_config['metrics_dir']):
+        if name == own or not name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(app_config['metrics_dir'], name),
+                      'rb') as f:
+                merged.merge(jsoncodec.loads(f.read()))
+        except (OSError, ValueError):
+            logging.debug(f'metrics_handler: Unable to read {name} metrics')
+    return(web.Response(text=merged.render(), content_type='text/plain'))
+
+async def dump_metrics(app_config):
+    registry = app_config['metrics']['registry']
+    path = os.path.join(app_config['metrics_dir'],
+                        f"{app_config['worker']}.json")
+    while True:
+        await asyncio.sleep(METRICSDUMPINTERVAL)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(jsoncodec.dumps(registry.snapshot()))
+        os.replace(path + '.tmp', path)
+
+def prepare_metrics(app_config):
+    registry = Registry()
+
+    def queue_sizes():
+        sizes = {}
+        if app_config['queue'] is not None:
+            sizes.update({('events',): app_config['queue'].qsize()})
+        for name, state in app_config['route_state'].items():
+            sizes.update({(name,): state['queue'].qsize()})
+        for name, state in app_config['source_state'].items():
+            sizes.update({(f'events:{name}',): state['queue'].qsize()})
+        return(sizes)
+
+    return({
+        'registry': registry,
+        'received': registry.counter('webrehook_events_received_total',
+            'Received requests'),
+        'skipped': registry.counter('webrehook_events_skipped_total',
+            'Received requests not processed by rules', ('reason',)),
+        'stage': registry.histogram('webrehook_stage_seconds',
+            'Time spent in pipeline stage', ('stage',)),
+        'rule_evaluations': registry.counter(
+            'webrehook_rule_evaluations_total',
+            'Rule evaluations', ('rule',)),
+        'rule_matches': registry.counter('webrehook_rule_matches_total',
+            'Rule matches', ('rule',)),
+        'rule_seconds': registry.histogram('webrehook_rule_seconds',
+            'Rule headers and when evaluation time', ('rule',)),
+        'route_attempts': registry.counter('webrehook_route_attempts_total',
+            'Delivery attempts', ('route',)),
+        'route_responses': registry.counter(
+            'webrehook_route_responses_total',
+            'Delivery responses by status, 0 is client error',
+            ('route', 'status')),
+        'route_seconds': registry.histogram('webrehook_route_seconds',
+            'Delivery attempt latency', ('route',)),
+        'route_retries': registry.counter('webrehook_route_retries_total',
+            'Scheduled delivery retries', ('route',)),
+        'route_dropped': registry.counter('webrehook_route_dropped_total',
+            'Deliveries dropped without success', ('route',)),
+        'route_expired': registry.counter('webrehook_route_expired_total',
+            'Deliveries dropped after deadline', ('route',)),
+        'capture_dropped': registry.counter('webrehook_capture_dropped_total',
+            'Requests not captured due full capture buffer'),
+        'route_inflight': registry.gauge('webrehook_route_inflight',
+            'Deliveries being sent now', ('route',)),
+        'inflight_bytes': registry.gauge('webrehook_inflight_bytes',
+            'Rendered bytes of deliveries kept in memory', (),
+            lambda: {(): app_config['budget'].used}
+                    if app_config.get('budget') is not None else {}),
+        'queue': registry.gauge('webrehook_queue_size',
+            'Items waiting in queue', ('queue',), queue_sizes),
+        'loop_lag': registry.histogram('webrehook_loop_lag_seconds',
+            'Event loop scheduling lag'),
+        })
+
+async def loop_lag_monitor(app_config):
+    loop_lag = app_config['metrics']['loop_lag']
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(LOOPLAGINTERVAL)
+        loop_lag.observe(
+            max(time.perf_counter() - started - LOOPLAGINTERVAL, 0))
+
+async def put_queue(queue, item, policy, dropped=None):
+# dropped is called with oldest item dropped by drop_oldest policy
+    if policy == 'block':
+        await queue.put(item)
+        return(True)
+
     try:
-        json_ = json.loads(text)
-    except ValueError:
-        logging.warning(f'send_handler: Broken JSON format in {name}')
-        return(None)
-    except:
-        logging.warning(f'send_handler: Unexpected JSON error in {name}:',
-                     sys.exc_info()[0])
-        return(None)
+        queue.put_nowait(item)
+    except asyncio.QueueFull:
+        if policy == 'reject':
+            return(False)
+        oldest = queue.get_nowait()
+        queue.task_done()
+        if dropped is not None:
+            dropped(oldest)
+        queue.put_nowait(item)
+        logging.warning('put_queue: Queue is full. Oldest item dropped.')
+    return(True)
 
-    i = 0
-    tries = arguments[TRIESARG]
-    while i < tries:
-        async with ClientSession() as session:
-            try:
-                async with session.post(url, json=json_) as resp:
-                    data = await resp.text()
-                    if resp.status >= 200 and resp.status < 300:
-                        return(None)
-                    else:
-                        logging.debug(
-                            f"send_handler: rule '{name}' received: {data}")
-            except aiohttp.ClientError:
-                logging.error(
-                    f"send_handler: HTTP client error in '{name}' rule:",
-                    sys.exc_info()[0])
-        i += 1
-        await asyncio.sleep(arguments[RETRYDELAYARG])
+async def event_worker(queue):
+# every event comes with config snapshot it was received with
+    while True:
+        snapshot, JSON, headers, body = await queue.get()
+        try:
+            matched = await process_rules(snapshot, JSON, headers)
+            if body is not None and not snapshot['capture'].put(
+                    headers, body, matched, snapshot['source']):
+                snapshot['metrics']['capture_dropped'].inc()
+        except asyncio.CancelledError:
+            raise
+        except:
+            logging.exception('event_worker: Unexpected error')
+        finally:
+            queue.task_done()
+# parsed event is not kept while waiting for the next one
+            snapshot = JSON = headers = body = None
 
-async def process_rules(app_config, JSON, headers):
-    routes = app_config['routes']
-    rules = app_config['rules']
-    templates = app_config['templates']
+async def route_worker(app_config, route):
+# settings, session and limits are taken on every delivery to see reloads
+    state = app_config['route_state'][route]
+    queue = state['queue']
     arguments = app_config['arguments']
+    metrics = app_config['metrics']
+    labels = (route,)
+    while True:
+        if state['retire']:
+            state['retire'] -= 1
+            state['tasks'].remove(asyncio.current_task())
+            return(None)
+        delivery = await queue.get()
+        breaker = probe = None
+        try:
+            breaker = state['breaker']
+            bucket = state['bucket']
+            deadline = delivery_deadline(app_config, delivery)
+            if deadline is not None and time.time() >= deadline:
+                await expire_delivery(app_config, delivery)
+                continue
 
-    for rule in rules:
-# match headers
-        upper_continue = False
-        for key, value in rule.get('headers', {}).items():
-            if headers.get(key) is not None and headers[key] == value:
+            if not breaker.allow():
+                await retry_delivery(app_config, delivery,
+                                     breaker.retry_after())
+                continue
+            probe = breaker.probing
+
+            await bucket.acquire()
+# rate limit or Retry-After pause may outlast deadline
+            if deadline is not None and time.time() >= deadline:
+                await expire_delivery(app_config, delivery)
                 continue
+# attempt never lasts past deadline
+            timeout = None
+            if deadline is not None:
+                total = max(deadline - time.time(), 0.001)
+                if state['settings']['timeout']:
+                    total = min(total, state['settings']['timeout'])
+                timeout = aiohttp.ClientTimeout(total=total,
+                    connect=state['settings']['connect_timeout'] or None,
+                    sock_read=state['settings']['read_timeout'] or None)
+            metrics['route_attempts'].inc(labels)
+            metrics['route_inflight'].inc(labels)
+            started = time.perf_counter()
+            try:
+                status, retry_after = await send_handler(delivery.body,
+                                    state['session'], state['settings']['url'],
+                                    delivery.rule, arguments, timeout,
+                                    delivery.encoding)
+            finally:
+                metrics['route_inflight'].dec(labels)
+            metrics['route_seconds'].observe(time.perf_counter() - started,
+                                             labels)
+            metrics['route_responses'].inc((route, status))
+            delivery.attempts += 1
+# any response but retryable failure shows destination is up
+            if status == 0 or status == 429 or status >= 500:
+                breaker.failure()
             else:
-                upper_continue = True
-                break
-        if upper_continue:
-            logging.debug(f"process_rules: \"{rule['name']}\"" +
-                          " rule does not match due headers")
+                breaker.success()
+            probe = False
+            if status >= 200 and status < 300:
+                if delivery.id is not None:
+                    await app_config['scheduler'].journal.remove(
+                        delivery.id)
+                continue
+
+            if retry_after:
+                bucket.pause(retry_after)
+            await retry_delivery(app_config, delivery, retry_after)
+        except asyncio.CancelledError:
+            state['interrupted'].append(delivery)
+            raise
+        except:
+            logging.exception('route_worker: Unexpected error in %s', route)
+        finally:
+            if probe:
+                breaker.abort()
+            app_config['budget'].release(len(delivery.body))
+            delivery = None
+            queue.task_done()
+
+async def retry_delivery(app_config, delivery, wait=0):
+    arguments = app_config['arguments']
+    scheduler = app_config['scheduler']
+    now = time.time()
+    deadline = delivery_deadline(app_config, delivery)
+    if deadline is not None and now + wait >= deadline:
+        await expire_delivery(app_config, delivery)
+        return(None)
+    tries = arguments[TRIESARG]
+    source = app_config['source_state'].get(delivery.source)
+    if source is not None:
+        tries = source['arguments'][TRIESARG]
+    if delivery.attempts >= tries:
+        logging.warning('retry_delivery: "%s" delivery to %s failed after ' +
+                        '%d attempts. Dropped.', delivery.rule,
+                        delivery.route, delivery.attempts)
+        app_config['metrics']['route_dropped'].inc((delivery.route,))
+        if delivery.id is not None:
+            await scheduler.journal.remove(delivery.id)
+        return(None)
+
+    delay = retry_delay(delivery.attempts, arguments[RETRYDELAYARG],
+                        arguments[MAXDELAYARG], arguments[JITTERARG])
+    app_config['metrics']['route_retries'].inc((delivery.route,))
+    await scheduler.schedule(delivery, now + max(delay, wait))
+
+async def enqueue_retry(app_config, delivery):
+    state = app_config['route_state'].get(delivery.route)
+    if state is None:
+        logging.warning('enqueue_retry: %s is absent in routes.yml. ' +
+                        'Delivery dropped.', delivery.route)
+        await app_config['scheduler'].journal.remove(delivery.id)
+        return(None)
+
+# scheduler runs in single task, so retry never waits for full queue or
+# drops queued deliveries whatever --overflow is, it is rescheduled instead
+    budget = app_config['budget']
+    queued = budget.take(len(delivery.body))
+    if queued:
+        queued = await put_queue(state['queue'], delivery, 'reject')
+        if not queued:
+            budget.release(len(delivery.body))
+    if not queued:
+        await app_config['scheduler'].schedule(delivery,
+                time.time() + app_config['arguments'][RETRYDELAYARG])
+
+def drop_delivery(app_config, delivery):
+# delivery dropped from full route queue by drop_oldest policy
+    app_config['budget'].release(len(delivery.body))
+    app_config['metrics']['route_dropped'].inc((delivery.route,))
+    if delivery.id is not None:
+        start_background(app_config,
+                         app_config['scheduler'].journal.remove(delivery.id))
+
+def start_background(app_config, coro):
+# one-off tasks are kept until they are done, like batch tasks
+    task = asyncio.create_task(coro)
+    app_config['background_tasks'].add(task)
+    task.add_done_callback(app_config['background_tasks'].discard)
+
+async def start_dispatch(app):
+    app_config = app['config']['app_config']
+    arguments = app_config['arguments']
+    tasks = app_config['tasks']
+
+    app_config['queue'] = asyncio.Queue(maxsize=arguments[QUEUEARG])
+    app_config['budget'] = ByteBudget(arguments[INFLIGHTBYTESARG])
+    if arguments[DEDUPSIZEARG]:
+        app_config['dedup'] = DedupCache(arguments[DEDUPSIZEARG],
+                                         arguments[DEDUPTTLARG])
+    for i in range(arguments[EVENTWORKERSARG]):
+        tasks.append(asyncio.create_task(event_worker(app_config['queue'])))
+    for name in app_config['sources'].keys():
+        start_source(app_config, name)
+
+def start_source(app_config, name):
+# source state is shared by all config snapshots like route state
+    arguments = app_config['sources'][name]['arguments']
+    queue = asyncio.Queue(maxsize=arguments[QUEUEARG])
+    app_config['source_state'].update({name: {
+        'arguments': arguments,
+        'queue': queue,
+        'tasks': [asyncio.create_task(event_worker(queue))
+                  for i in range(arguments[EVENTWORKERSARG])]}})
+
+async def drain_queue(queue, timeout):
+# waits for workers to process queued events, at most timeout seconds
+    try:
+        await asyncio.wait_for(queue.join(), timeout)
+    except asyncio.TimeoutError:
+        logging.warning('drain_queue: %d events are not processed in time',
+                        queue.qsize())
+
+async def stop_source(state, drain=False):
+    if drain:
+        await state['queue'].join()
+    for task in state['tasks']:
+        task.cancel()
+    await asyncio.gather(*state['tasks'], return_exceptions=True)
+
+def update_sources(app_config):
+# applies reloaded sources: removed ones are drained and stopped, new ones
+# are started, queue and workers of existing ones change on restart only
+    source_state = app_config['source_state']
+    for name in list(source_state.keys()):
+        if name not in app_config['sources']:
+            state = source_state.pop(name)
+            start_background(app_config, stop_source(state, drain=True))
+
+    for name, source in app_config['sources'].items():
+        state = source_state.get(name)
+        if state is None:
+            start_source(app_config, name)
             continue
+        for arg in (QUEUEARG, EVENTWORKERSARG):
+            if state['arguments'][arg] != source['arguments'][arg]:
+                logging.warning(f'update_sources: {name} {arg} is changed ' +
+                                'on restart only')
+        state.update({'arguments': source['arguments']})
+
+def orphan_journals(path, worker, workers):
+# returns journal files no worker of this run owns, e.g. left by run with
+# more or without workers
+    root, ext = os.path.splitext(path)
+    if worker is None:
+        owned = {path}
+    else:
+        owned = {f'{root}.{i}{ext}' for i in range(workers)}
+    found = [path] if os.path.exists(path) else []
+    for name in glob.glob(f'{glob.escape(root)}.*{ext}'):
+        if name[len(root) + 1:len(name) - len(ext)].isdigit():
+            found.append(name)
+    return(sorted(name for name in found if name not in owned))
+
+async def start_retries(app):
+    app_config = app['config']['app_config']
+    arguments = app_config['arguments']
+    path = arguments[JOURNALARG]
+    orphans = []
+    if path:
+        path = arguments[CONFDIRARG] + path
+# first worker takes over deliveries of journals no worker owns
+        if app_config['worker'] in (None, 0):
+            orphans = orphan_journals(path, app_config['worker'],
+                                      arguments[WORKERSARG])
+        if app_config['worker'] is not None:
+            root, ext = os.path.splitext(path)
+            path = f"{root}.{app_config['worker']}{ext}"
+    else:
+        path = ':memory:'
 
-# match when conditions
+    journal = Journal(path)
+    for orphan in orphans:
         try:
-            when_matched = eval(rule['when'])
-        except ValueError:
-            logging.error(
-                f"process_rules: Value error in {rule['name']}. Exiting.")
-            continue
-        except TypeError:
-            logging.error(
-                f"process_rules: Type error in {rule['name']}. Exiting.")
+            adopted = await journal.adopt(orphan)
+        except (sqlite3.Error, OSError):
+            logging.exception('start_retries: Unable to adopt %s', orphan)
             continue
+        logging.info('start_retries: %d deliveries adopted from %s',
+                     adopted, orphan)
+    scheduler = RetryScheduler(journal,
+        lambda delivery: enqueue_retry(app_config, delivery))
+    await scheduler.start()
+    app_config['scheduler'] = scheduler
+    app_config['tasks'].append(asyncio.create_task(scheduler.run()))
+
+async def stop_retries(app):
+    app_config = app['config']['app_config']
+    scheduler = app_config['scheduler']
+# journal rows of deliveries dropped on stop are removed before closing
+    await asyncio.gather(*app_config['background_tasks'],
+                         return_exceptions=True)
+    if scheduler is not None:
+        await scheduler.journal.close()
+
+async def start_capture(app):
+    app_config = app['config']['app_config']
+    arguments = app_config['arguments']
+    if not arguments[CAPTUREARG]:
+        return(None)
+    name = os.getpid() if app_config['worker'] is None \
+        else app_config['worker']
+    capture = Capture(arguments[CONFDIRARG] + arguments[CAPTUREARG], name,
+                      arguments[CAPTUREBYTESARG], arguments[CAPTURESECONDSARG],
+                      arguments[CAPTUREGZIPARG],
+                      [header for header in
+                       arguments[CAPTUREREDACTARG].split(',') if header],
+                      arguments[CAPTUREBUFFERARG])
+    try:
+        capture.start()
+    except OSError:
+        logging.error(f'start_capture: Unable to use {capture.directory}')
+        return(None)
+    app_config['capture'] = capture
+
+async def stop_capture(app):
+    capture = app['config']['app_config']['capture']
+    if capture is not None:
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, capture.stop)
+
+async def start_metrics(app):
+    app_config = app['config']['app_config']
+    app_config['tasks'].append(
+        asyncio.create_task(loop_lag_monitor(app_config)))
+    if app_config['metrics_dir'] is not None:
+        app_config['tasks'].append(
+            asyncio.create_task(dump_metrics(app_config)))
+
+async def start_reload(app):
+    app['reload_lock'] = asyncio.Lock()
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(signal.SIGHUP, lambda:
+        start_background(app['config']['app_config'], reload_config(app)))
+
+async def reload_config(app):
+# new config is prepared in thread and swapped at once, events already
+# received keep the snapshot they came with
+    async with app['reload_lock']:
+        old = app['config']['app_config']
+        loop = asyncio.get_running_loop()
+        try:
+            config = await loop.run_in_executor(None, load_config,
+                                                old['arguments'], old['cache'])
         except:
-            logging.error(
-                "process_rules: Unexpected error in {rule['name']}:",
-                sys.exc_info()[0])
+            logging.exception('reload_config: Unexpected error')
+            config = None
+        if config is None:
+            logging.error('reload_config: Config is not reloaded.')
+            return(False)
+
+        app_config = dict(old)
+        app_config.update(config)
+        bind_sources(app_config)
+        await update_routes(app_config, config['routes'])
+        update_sources(app_config)
+        app['config']['app_config'] = app_config
+        logging.info('reload_config: Config reloaded.')
+        return(True)
+
+def check_admin(app_config, request):
+    token = app_config['arguments'][ADMINTOKENARG]
+# constant time comparison does not reveal how much of token is guessed
+    if not token or not hmac.compare_digest(
+            request.headers.get('X-Admin-Token', '').encode(), token.encode()):
+        raise web.HTTPForbidden
+
+async def reload_handler(request):
+    app_config = request.app['config']['app_config']
+    check_admin(app_config, request)
+# workers are reloaded all together by supervisor
+    if app_config['worker'] is not None:
+        os.kill(os.getppid(), signal.SIGHUP)
+        raise web.HTTPAccepted
+    if not await reload_config(request.app):
+        raise web.HTTPInternalServerError
+    raise web.HTTPOk
+
+async def profile_handler(request):
+# slowest rules of profiled events of this worker
+    app_config = request.app['config']['app_config']
+    check_admin(app_config, request)
+    if app_config['profiler'] is None:
+        raise web.HTTPNotFound
+    return(web.Response(body=jsoncodec.dumps(app_config['profiler'].table()),
+                        content_type='application/json'))
+
+async def explain_handler(request):
+# takes {"headers": {...}, "body": ..., "source": ...} like capture record
+# and returns how every rule of the source handles it, nothing is sent
+    app_config = request.app['config']['app_config']
+    check_admin(app_config, request)
+    try:
+        event = jsoncodec.loads(await request.read())
+        headers = CIMultiDict(event.get('headers') or {})
+        JSON = event['body']
+        if isinstance(JSON, str):
+            JSON = jsoncodec.loads(JSON)
+        source = event.get('source')
+    except (ValueError, KeyError, AttributeError, TypeError):
+        raise web.HTTPBadRequest
+    if source is not None:
+        app_config = app_config['sources'].get(source)
+        if app_config is None:
+            raise web.HTTPNotFound
+    return(web.Response(body=jsoncodec.dumps(
+                            explain_rules(app_config, JSON, headers)),
+                        content_type='application/json'))
+
+async def stop_dispatch(app):
+    app_config = app['config']['app_config']
+# server does not accept events any more, so queued ones are processed
+# before workers are cancelled
+    queues = [state['queue'] for state in app_config['source_state'].values()]
+    if app_config['queue'] is not None:
+        queues.append(app_config['queue'])
+    await asyncio.gather(*[drain_queue(queue, DRAINTIMEOUT)
+                           for queue in queues])
+    for state in app_config['source_state'].values():
+        await stop_source(state)
+    app_config['source_state'].clear()
+    tasks = app_config['tasks'] + list(app_config['background_tasks'])
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    app_config['tasks'].clear()
+# events are not processed any more, so open batches are sent before routes
+# are stopped
+    for snapshot, i in list(app_config['open_batches'].values()):
+        flush_batch(snapshot, i)
+    await asyncio.gather(*app_config['batch_tasks'], return_exceptions=True)
+
+def render_template(template, JSON, name, JSONS=None):
+# renders and validates template once, returns encoded body for all routes.
+# Batch templates get all batched events as JSONS and first one as JSON
+    text = template.render(JSON = JSON, JSONS = JSONS)
+    try:
+        json_ = jsoncodec.loads(text)
+    except ValueError:
+        logging.warning('render_template: Broken JSON format in %s', name)
+        return(None)
+    except:
+        logging.warning('render_template: Unexpected JSON error in %s', name,
+                        exc_info=True)
+        return(None)
+    return(jsoncodec.dumps(json_))
+
+async def send_handler(body, session, url, name, arguments, timeout=None,
+                       encoding=None):
+# returns response status, 0 on client error or timeout, and Retry-After
+# seconds. Timeout overrides session one, encoding is Content-Encoding of
+# already compressed body
+    kwargs = {}
+    if timeout is not None:
+        kwargs.update({'timeout': timeout})
+    headers = SENDHEADERS
+    if encoding is not None:
+        headers = dict(SENDHEADERS, **{'Content-Encoding': encoding})
+    try:
+        async with session.post(url, data=body, headers=headers,
+                                **kwargs) as resp:
+            data = await resp.text()
+            if resp.status >= 200 and resp.status < 300:
+                return(resp.status, 0)
+            else:
+                logging.debug("send_handler: rule '%s' received: %s", name,
+                              data)
+            return(resp.status,
+                   parse_retry_after(resp.headers.get('Retry-After'),
+                                     arguments[MAXDELAYARG]))
+    except aiohttp.ClientError:
+        logging.error("send_handler: HTTP client error in '%s' rule: %r",
+                      name, sys.exc_info()[1])
+    except asyncio.TimeoutError:
+        logging.error("send_handler: Timeout in '%s' rule", name)
+    return(0, 0)
+
+def evict_oldest(app_config):
+# drops oldest queued delivery of all routes, returns False when nothing
+# is queued. Queue head is peeked, asyncio.Queue keeps items in _queue
+    oldest = None
+    for state in app_config['route_state'].values():
+        queue = state['queue']
+        if not queue.empty() and (oldest is None or
+                queue._queue[0].created < oldest._queue[0].created):
+            oldest = queue
+    if oldest is None:
+        return(False)
+    delivery = oldest.get_nowait()
+    oldest.task_done()
+    drop_delivery(app_config, delivery)
+    return(True)
+
+async def take_budget(app_config, size):
+# returns False when size does not fit in-flight bytes budget. block policy
+# waits for it, drop_oldest one drops oldest queued deliveries to fit it
+    budget = app_config['budget']
+    policy = app_config['arguments'][OVERFLOWARG]
+    if policy == 'block':
+        await budget.acquire(size)
+        return(True)
+    while not budget.take(size):
+        if policy != 'drop_oldest' or not evict_oldest(app_config):
+            return(False)
+    return(True)
+
+async def queue_deliveries(app_config, rule, body):
+    if body is None:
+        return(None)
+
+    policy = app_config['arguments'][OVERFLOWARG]
+    budget = app_config['budget']
+# body is compressed once for all routes compressing it
+    compressed = None
+    for route in rule['routes']:
+        state = app_config['route_state'].get(route)
+        if state is None:
             continue
-        if not when_matched:
-            logging.debug(f"process_rules: \"{rule['name']}\"" +
-                          " rule does not match due when")
+        data = body
+        encoding = None
+        if state['settings']['compress'] and \
+                len(body) >= state['settings']['compress']:
+            if compressed is None:
+                compressed = gzip.compress(body, COMPRESSLEVEL)
+            data = compressed
+            encoding = 'gzip'
+        if not await take_budget(app_config, len(data)):
+            logging.warning('queue_deliveries: In-flight bytes limit is ' +
+                            'reached. "%s" delivery to %s dropped',
+                            rule['name'], route)
+            app_config['metrics']['route_dropped'].inc((route,))
             continue
+        delivery = Delivery(route, rule['name'], data, time.time(),
+                            source=app_config['source'], encoding=encoding)
+        queued = await put_queue(state['queue'], delivery, policy,
+                                 lambda oldest: drop_delivery(app_config,
+                                                              oldest))
+        if not queued:
+            budget.release(len(data))
+            logging.warning('queue_deliveries: %s queue is full. "%s" ' +
+                            'delivery dropped', route, rule['name'])
+            app_config['metrics']['route_dropped'].inc((route,))
 
-        logging.debug(f"process_rules: \"{rule['name']}\" rule matched")
+async def add_to_batch(app_config, i, JSON):
+# batch is flushed when it gets batch events or in batch ms after first one.
+# Events are kept encoded and counted in in-flight bytes budget, so parsed
+# event is released as for not batched rules
+    rule = app_config['rules'][i]
+    event = jsoncodec.dumps(JSON)
+    if not await take_budget(app_config, len(event)):
+        logging.warning('add_to_batch: In-flight bytes limit is reached. ' +
+                        '"%s" batch event dropped', rule['name'])
         for route in rule['routes']:
-            asyncio.create_task(send_handler(JSON, routes[route],
-                        rule['name'], templates[rule['template']], arguments))
+            app_config['metrics']['route_dropped'].inc((route,))
+        return(None)
+    batches = app_config['batches']
+    if i not in batches:
+        loop = asyncio.get_running_loop()
+        timer = loop.call_later(rule['batch']['ms'] / 1000,
+                                flush_batch, app_config, i)
+        batches.update({i: {'events': [], 'timer': timer}})
+# open batches of all snapshots are known to flush them on stop
+        app_config['open_batches'].update(
+            {(id(batches), i): (app_config, i)})
+
+    batch = batches[i]
+    batch['events'].append(event)
+    if len(batch['events']) >= rule['batch']['events']:
+        flush_batch(app_config, i)
 
-        if rule["done"]:
+def flush_batch(app_config, i):
+    batch = app_config['batches'].pop(i, None)
+    if batch is None:
+        return(None)
+    app_config['open_batches'].pop((id(app_config['batches']), i), None)
+    batch['timer'].cancel()
+    task = asyncio.create_task(send_batch(app_config, i, batch['events']))
+    app_config['batch_tasks'].add(task)
+    task.add_done_callback(app_config['batch_tasks'].discard)
+
+async def send_batch(app_config, i, events):
+    rule = app_config['rules'][i]
+    template = app_config['templates'][rule['batch']['template']]
+    logging.debug('send_batch: "%s" batch of %d', rule['name'], len(events))
+    started = time.perf_counter()
+    size = sum(len(event) for event in events)
+    try:
+        events = [jsoncodec.loads(event) for event in events]
+        body = render_template(template, events[0], rule['name'], events)
+    finally:
+        app_config['budget'].release(size)
+        events = None
+    app_config['metrics']['stage'].observe(time.perf_counter() - started,
+                                           ('render',))
+    await queue_deliveries(app_config, rule, body)
+
+async def process_rules(app_config, JSON, headers):
+    rules = app_config['rules']
+    templates = app_config['templates']
+    metrics = app_config['metrics']
+    memo = {}
+    rendered = {}
+    matched = []
+
+    started = time.perf_counter()
+    candidates = candidate_rules(app_config['index'], JSON, headers, memo)
+    matching = time.perf_counter() - started
+    timings = None
+    if app_config['profiler'] is not None and \
+            random.random() < app_config['arguments'][PROFILESAMPLEARG]:
+        timings = []
+
+    for i, when_matched, elapsed in evaluate_rules(rules, candidates, JSON,
+                                                   headers, memo, timings):
+        rule = rules[i]
+        matching += elapsed
+        metrics['rule_evaluations'].inc((rule['name'],))
+        metrics['rule_seconds'].observe(elapsed, (rule['name'],))
+        if not when_matched:
+            continue
+
+        metrics['rule_matches'].inc((rule['name'],))
+        matched.append(rule['name'])
+        logging.debug('process_rules: "%s" rule matched', rule['name'])
+        if rule.get('batch') is not None:
+            await add_to_batch(app_config, i, JSON)
+        else:
+            if rule['template'] not in rendered:
+                started = time.perf_counter()
+                rendered.update({rule['template']: render_template(
+                    templates[rule['template']], JSON, rule['name'])})
+                metrics['stage'].observe(time.perf_counter() - started,
+                                         ('render',))
+            await queue_deliveries(app_config, rule,
+                                   rendered[rule['template']])
+
+    metrics['stage'].observe(matching, ('match',))
+    if timings is not None:
+        for i, headers_seconds, when_seconds in timings:
+            app_config['profiler'].record(app_config['source'],
+                rules[i]['name'], headers_seconds, when_seconds)
+    return(matched)
+
+def evaluate_rules(rules, candidates, JSON, headers, memo, timings=None):
+# yields (rule index, matched, seconds) for candidate rules in order, stops
+# after matched rule with done. Header match and when seconds of every rule
+# are appended to timings list when it is given
+    for i in candidates:
+        started = time.perf_counter()
+        if timings is None:
+            when_matched = match_rule(rules[i], JSON, headers, memo)
+        else:
+            when_matched = match_headers(rules[i], headers)
+            headers_matched = time.perf_counter()
+            if when_matched:
+                when_matched = match_when(rules[i], JSON, memo)
+            timings.append((i, headers_matched - started,
+                            time.perf_counter() - headers_matched))
+        yield(i, when_matched, time.perf_counter() - started)
+        if when_matched and rules[i]['done']:
             break
 
+def match_rule(rule, JSON, headers, memo):
+    return(match_headers(rule, headers) and match_when(rule, JSON, memo))
+
+def match_headers(rule, headers):
+    for key, value in rule.get('headers', {}).items():
+        if headers.get(key) is None or headers[key] != value:
+            logging.debug('match_headers: "%s" rule does not match due ' +
+                          'headers', rule['name'])
+            return(False)
+    return(True)
+
+def match_when(rule, JSON, memo):
+    try:
+        when_matched = rule['when'](JSON, memo)
+    except ValueError:
+        logging.error('match_when: Value error in %s. Exiting.', rule['name'])
+        return(False)
+    except TypeError:
+        logging.error('match_when: Type error in %s. Exiting.', rule['name'])
+        return(False)
+    except:
+        logging.exception('match_when: Unexpected error in %s', rule['name'])
+        return(False)
+    if not when_matched:
+        logging.debug('match_when: "%s" rule does not match due when',
+                      rule['name'])
+        return(False)
+    return(True)
+
+def explain_rules(config, JSON, headers):
+# evaluates every rule in order like process_rules would, with header and
+# when results, JSON paths read by when and seconds spent. Paths are known
+# for closure backend only, eval one does not read through memo
+    rules = config['rules']
+    candidates = set(candidate_rules(config['index'], JSON, headers, {}))
+    explained = []
+    stopped = False
+    for i, rule in enumerate(rules):
+        memo = {}
+        started = time.perf_counter()
+        headers_matched = match_headers(rule, headers)
+        headers_done = time.perf_counter()
+        when_matched = None
+        if headers_matched:
+            when_matched = match_when(rule, JSON, memo)
+        when_done = time.perf_counter()
+        delivered = i in candidates and bool(when_matched) and not stopped
+        if delivered and rule['done']:
+            stopped = True
+        explained.append({
+            'rule': rule['name'],
+            'candidate': i in candidates,
+            'headers': headers_matched,
+            'when': when_matched,
+            'paths': [list(path) for path in memo.keys()
+                      if not any(other[:len(path)] == path and other != path
+                                 for other in memo.keys())],
+            'headers_seconds': headers_done - started,
+            'when_seconds': when_done - headers_done,
+            'matched': delivered,
+            'done': delivered and rule['done']})
+    return({'prefilter': headers_match(config['prefilter'], headers),
+            'rules': explained})
+
 def get_arguments():
     output = {}
 
@@ -288,7 +1610,8 @@ def get_arguments():
         name = '--' + item["name"]
         default = item["default"]
         help_ = item["help"] + f" (default: {default})"
-        parser.add_argument(name, default=default, help=help_)
+        parser.add_argument(name, default=default, help=help_,
+                            choices=item.get("choices"))
     parsed_args = vars(parser.parse_args())
 
     for item in ARGSTOPARSE:
@@ -304,6 +1627,17 @@ def get_arguments():
             if value[-1] != '/':
                 value += '/'
 
+        if item.get("type") is not None:
+            try:
+                value = item["type"](value)
+            except ValueError:
+                logging.error(f'get_arguments: Wrong {name} value. Exiting.')
+                continue
+
+        if item.get("choices") is not None and value not in item["choices"]:
+            logging.error(f'get_arguments: Wrong {name} value. Exiting.')
+            continue
+
         output.update({name: value})
 
     return(output)
@@ -317,26 +1651,321 @@ DONEARG = 'autodone'
 RETRYDELAYARG = 'delay'
 TRIESARG = 'tries'
 VERBOSEARG = 'verbose'
+LOGRATEARG = 'log_rate'
+LOGBURSTARG = 'log_burst'
+LOGTRUNCATEARG = 'log_truncate'
+LOGQUEUEARG = 'log_queue'
+QUEUEARG = 'queue'
+EVENTWORKERSARG = 'event_workers'
+ROUTEQUEUEARG = 'route_queue'
+ROUTEWORKERSARG = 'route_workers'
+OVERFLOWARG = 'overflow'
+OVERFLOWPOLICIES = ['reject', 'drop_oldest', 'block']
+WHENBACKENDARG = 'when_backend'
+WHENBACKENDS = ['closure', 'eval']
+MAXBODYARG = 'max_body'
+MAXDECOMPRESSEDARG = 'max_decompressed'
+MAXDELAYARG = 'max_delay'
+JITTERARG = 'jitter'
+MAXAGEARG = 'max_age'
+JOURNALARG = 'journal'
+WORKERSARG = 'workers'
+ADMINTOKENARG = 'admin_token'
+AUTOESCAPEPOLICIES = ['off', 'on', 'html']
+UNDEFINEDPOLICIES = {'default': jinja2.Undefined,
+                     'strict': jinja2.StrictUndefined,
+                     'debug': jinja2.DebugUndefined,
+                     'chainable': jinja2.ChainableUndefined}
+WHENCACHEARG = 'when_cache'
+INFLIGHTBYTESARG = 'inflight_bytes'
+JSONCODECARG = 'json_codec'
+PROFILESAMPLEARG = 'profile_sample'
+PROFILETOPARG = 'profile_top'
+LOOPARG = 'loop'
+LOOPS = ['asyncio', 'uvloop']
+DEDUPHEADERARG = 'dedup_header'
+DEDUPHASHARG = 'dedup_hash'
+DEDUPSIZEARG = 'dedup_size'
+DEDUPTTLARG = 'dedup_ttl'
+CAPTUREARG = 'capture'
+CAPTUREBYTESARG = 'capture_bytes'
+CAPTURESECONDSARG = 'capture_seconds'
+CAPTUREGZIPARG = 'capture_gzip'
+CAPTURESAMPLEARG = 'capture_sample'
+CAPTUREREDACTARG = 'capture_redact'
+CAPTUREBUFFERARG = 'capture_buffer'
+REPLAYARG = 'replay'
+REPLAYCOMPAREARG = 'replay_compare'
+REPLAYPROCESSESARG = 'replay_processes'
+REPLAYDELIVERARG = 'replay_deliver'
+TEMPLATECACHEARG = 'template_cache'
+AUTOESCAPEARG = 'autoescape'
+UNDEFINEDARG = 'undefined'
 ARGSTOPARSE = [
     {"name": CONFDIRARG,
      "default": "./",
      "help": "path to confdir"},
     {"name": PORTARG,
      "default": 8080,
+     "type": int,
      "help": "port to listen"},
     {"name": DONEARG,
      "default": True,
      "help": "done when any rule match"},
     {"name": RETRYDELAYARG,
      "default": 5,
-     "help": "retry delay seconds"},
+     "type": float,
+     "help": "first retry delay seconds"},
     {"name": TRIESARG,
      "default": 1,
+     "type": int,
      "help": "max amount of send attemps"},
     {"name": VERBOSEARG,
      "default": 10,
-     "help": "logging verbose"}
+     "type": int,
+     "help": "logging verbose"},
+    {"name": LOGRATEARG,
+     "default": 10,
+     "type": float,
+     "help": "log messages per second of every message type above " +
+             "--log_burst, others are suppressed and counted, 0 is unlimited"},
+    {"name": LOGBURSTARG,
+     "default": 100,
+     "type": int,
+     "help": "log messages of every message type allowed at once"},
+    {"name": LOGTRUNCATEARG,
+     "default": 2000,
+     "type": int,
+     "help": "max characters of log message, payloads are cut to it, " +
+             "0 is unlimited"},
+    {"name": LOGQUEUEARG,
+     "default": 10000,
+     "type": int,
+     "help": "max log messages waiting to be written, new ones are " +
+             "dropped and counted when stderr is slow"},
+    {"name": QUEUEARG,
+     "default": 1000,
+     "type": int,
+     "help": "max amount of received events waiting for rules processing"},
+    {"name": EVENTWORKERSARG,
+     "default": 4,
+     "type": int,
+     "help": "amount of rules processing workers"},
+    {"name": ROUTEQUEUEARG,
+     "default": 1000,
+     "type": int,
+     "help": "max amount of deliveries waiting in each route queue"},
+    {"name": ROUTEWORKERSARG,
+     "default": 2,
+     "type": int,
+     "help": "amount of delivery workers for each route"},
+    {"name": OVERFLOWARG,
+     "default": "reject",
+     "choices": OVERFLOWPOLICIES,
+     "help": "policy when queue is full: reject new item with 429, " +
+             "drop oldest item or block until queue has space"},
+    {"name": WHENBACKENDARG,
+     "default": "closure",
+     "choices": WHENBACKENDS,
+     "help": "rules when evaluation: compiled closures or python eval"},
+    {"name": MAXBODYARG,
+     "default": 1048576,
+     "type": int,
+     "help": "max received request body size in bytes, larger get 413"},
+    {"name": MAXDECOMPRESSEDARG,
+     "default": 10485760,
+     "type": int,
+     "help": "max size in bytes of gzip or deflate request body after " +
+             "decompression, larger get 413"},
+    {"name": MAXDELAYARG,
+     "default": 300,
+     "type": float,
+     "help": "max retry delay seconds, delay doubles on every attempt"},
+    {"name": JITTERARG,
+     "default": 0.1,
+     "type": float,
+     "help": "retry delay random spread share"},
+    {"name": MAXAGEARG,
+     "default": 3600,
+     "type": float,
+     "help": "seconds since event after which delivery is abandoned, 0 " +
+             "is unlimited"},
+    {"name": JOURNALARG,
+     "default": "journal.sqlite",
+     "help": "retries journal file in confdir, empty keeps it in memory"},
+    {"name": WORKERSARG,
+     "default": 1,
+     "type": int,
+     "help": "amount of worker processes sharing port"},
+    {"name": ADMINTOKENARG,
+     "default": "",
+     "help": "X-Admin-Token header value for admin endpoints, empty " +
+             "disables them"},
+    {"name": WHENCACHEARG,
+     "default": "when.cache",
+     "help": "parsed when expressions cache file in confdir, empty " +
+             "disables it"},
+    {"name": TEMPLATECACHEARG,
+     "default": "template.cache",
+     "help": "compiled templates bytecode cache dir in confdir, empty " +
+             "disables it"},
+    {"name": AUTOESCAPEARG,
+     "default": "off",
+     "choices": AUTOESCAPEPOLICIES,
+     "help": "templates autoescape: off, on or for .html and .xml only"},
+    {"name": UNDEFINEDARG,
+     "default": "default",
+     "choices": list(UNDEFINEDPOLICIES),
+     "help": "templates undefined variables: render empty, fail, render " +
+             "as is or allow attributes of undefined"},
+    {"name": PROFILESAMPLEARG,
+     "default": 0,
+     "type": float,
+     "help": "share of events to profile rules evaluation of, 0 " +
+             "disables profiling"},
+    {"name": PROFILETOPARG,
+     "default": 20,
+     "type": int,
+     "help": "amount of slowest rules shown by /-/profile"},
+    {"name": JSONCODECARG,
+     "default": "auto",
+     "choices": jsoncodec.CODECS,
+     "help": "JSON library: fastest installed one of orjson, ujson and " +
+             "json, or given one"},
+    {"name": LOOPARG,
+     "default": "asyncio",
+     "choices": LOOPS,
+     "help": "event loop: asyncio or uvloop when installed"},
+    {"name": INFLIGHTBYTESARG,
+     "default": 268435456,
+     "type": int,
+     "help": "max rendered bytes of deliveries kept in memory, --overflow " +
+             "policy applies above it, 0 is unlimited"},
+    {"name": DEDUPHEADERARG,
+     "default": "X-Gitlab-Event-UUID",
+     "help": "header identifying event for duplicates suppression, " +
+             "events without it are not suppressed unless --dedup_hash"},
+    {"name": DEDUPHASHARG,
+     "default": 0,
+     "type": int,
+     "help": "use payload hash as identity of events without " +
+             "--dedup_header when 1, equal payloads are then suppressed " +
+             "even for different events"},
+    {"name": DEDUPSIZEARG,
+     "default": 10000,
+     "type": int,
+     "help": "max amount of remembered events, 0 disables duplicates " +
+             "suppression"},
+    {"name": DEDUPTTLARG,
+     "default": 600,
+     "type": float,
+     "help": "seconds event is remembered for duplicates suppression"},
+    {"name": CAPTUREARG,
+     "default": "",
+     "help": "dir in confdir to capture received requests to as JSONL " +
+             "for replay, empty disables capture"},
+    {"name": CAPTUREBYTESARG,
+     "default": 104857600,
+     "type": int,
+     "help": "capture file size in bytes to start new file after"},
+    {"name": CAPTURESECONDSARG,
+     "default": 3600,
+     "type": float,
+     "help": "capture file age in seconds to start new file after"},
+    {"name": CAPTUREGZIPARG,
+     "default": 0,
+     "type": int,
+     "help": "gzip capture files when 1"},
+    {"name": CAPTURESAMPLEARG,
+     "default": 1.0,
+     "type": float,
+     "help": "share of received requests to capture"},
+    {"name": CAPTUREREDACTARG,
+     "default": "X-Gitlab-Token,Authorization",
+     "help": "comma separated headers to not capture values of"},
+    {"name": CAPTUREBUFFERARG,
+     "default": 1000,
+     "type": int,
+     "help": "max requests waiting to be written, new ones are dropped " +
+             "when disk is slow"},
+    {"name": REPLAYARG,
+     "default": "",
+     "help": "JSONL archive of requests with headers and body to run " +
+             "through rules and report instead of serving"},
+    {"name": REPLAYCOMPAREARG,
+     "default": "",
+     "help": "other confdir to compare replay matches and output with"},
+    {"name": REPLAYPROCESSESARG,
+     "default": 0,
+     "type": int,
+     "help": "amount of replay processes, 0 is amount of cpus"},
+    {"name": REPLAYDELIVERARG,
+     "default": "",
+     "help": "url to post replay output to as <url>/<route> instead of " +
+             "routes, empty does not deliver"}
     ]
+# optional per-route settings in routes.yml, a route may be set either as
+# plain url or as dict with url and any of these keys
+ROUTEDEFAULTS = {
+    'limit': 100,           # max connections in route pool
+    'limit_per_host': 0,    # max connections per host, 0 is unlimited
+    'keepalive': 15,        # idle keep-alive connection timeout, seconds
+    'dns_ttl': 10,          # dns cache ttl, seconds, 0 disables cache
+    'queue': 0,             # max deliveries in route queue, 0 is --route_queue
+    'workers': 0,           # route delivery workers, 0 is --route_workers
+    'breaker_failures': 0,  # failures in a row opening breaker, 0 disables
+    'breaker_reset': 30,    # open breaker seconds before probe delivery
+    'rate': 0,              # deliveries per second, 0 is unlimited
+    'burst': 1,             # deliveries allowed at once above rate
+    'connect_timeout': 10,  # connection timeout, seconds, 0 is unlimited
+    'read_timeout': 30,     # response read timeout, seconds, 0 is unlimited
+    'timeout': 60,          # whole request timeout, seconds, 0 is unlimited
+    'deadline': 0,          # seconds since event to give up delivery after,
+                            # 0 is --max_age
+    'compress': 0           # min body bytes to send gzip compressed, 0 sends
+                            # uncompressed
+    }
+
+# optional ingest sources in sources.yml, each source is served at
+# /hooks/<source> with its own rules and any of these keys
+SOURCEDEFAULTS = {
+    'rules': '',                # rules file in confdir, empty is
+                                # rules.<source>.yml
+    'templates': 'templates/',  # templates dir in confdir
+    'autodone': None,           # done when any rule match, None is --autodone
+    'tries': 0,                 # max send attempts, 0 is --tries
+    'queue': 0,                 # max events waiting, 0 is --queue
+    'event_workers': 0          # rules processing workers, 0 is
+                                # --event_workers
+    }
+# source settings overriding arguments
+SOURCEARGS = {'tries': TRIESARG,
+              'queue': QUEUEARG,
+              'event_workers': EVENTWORKERSARG}
+SOURCENAME = re.compile(r'^[\w-]+$')
+
+SENDHEADERS = {'Content-Type': 'application/json'}
+# accepted request Content-Encoding and its zlib wbits, None is not
+# compressed
+CONTENTENCODINGS = {'identity': None,
+                    'gzip': 16 + zlib.MAX_WBITS,
+                    'deflate': zlib.MAX_WBITS}
+# compressed request body bytes read at once
+READCHUNK = 65536
+COMPRESSLEVEL = 6
+LOOPLAGINTERVAL = 1
+METRICSDUMPINTERVAL = 5
+RESTARTDELAY = 1
+# seconds to let replaced route session finish requests before closing it
+SESSIONGRACE = 60
+# seconds to let event workers process queued events on stop
+DRAINTIMEOUT = 10
+# when cache file is valid for the same python bytecode and cache format
+WHENCACHEHEADER = b'webrehook-when-1' + importlib.util.MAGIC_NUMBER
+WHENLEXER = WhenLexer()
+WHENPARSER = WhenParser()
+# names available to compiled when expressions
+WHENNAMES = {'json_query_recursive': json_query_recursive}
 
 def main():
     arguments = get_arguments()
@@ -346,29 +1975,216 @@ def main():
 
     logging.basicConfig(level=arguments[VERBOSEARG])
 
+    logging.info(f'main: {jsoncodec.use(arguments[JSONCODECARG])} ' +
+                 'JSON codec is used')
+
+    if arguments[REPLAYARG]:
+        from replay import replay
+        sys.exit(replay(arguments))
+
+    config, cache = prepare_config(arguments)
+    if config is None:
+        sys.exit(1)
+
+    app_config = dict(config)
+    app_config.update({'arguments': arguments,
+                       'cache': cache,
+                       'worker': None,
+                       'metrics_dir': None})
+
+# while serving log messages are formatted and written by background thread,
+# workers start their own one after fork
+    if arguments[WORKERSARG] > 1:
+        run_workers(app_config, arguments[WORKERSARG])
+    else:
+        start_logging(arguments)
+        run_app(app_config)
+
+def prepare_config(arguments):
+# returns config snapshot or None and cache to reuse on reload
+    cache = new_cache()
+    if arguments[WHENCACHEARG]:
+        cache['parsed'] = load_when_cache(
+            arguments[CONFDIRARG] + arguments[WHENCACHEARG])
+    return(load_config(arguments, cache), cache)
+
+def load_config(arguments, cache):
+# returns config snapshot part of app_config or None. Rules of rules.yml
+# are served at / and their partition is kept at top level, partitions of
+# sources.yml sources are kept in sources
+    cache['used'] = {}
     routes = load_yml(f"{arguments[CONFDIRARG]}routes.yml")
     if routes == False:
-        sys.exit(1)
+        return(None)
 
     if check_routes(routes) == False:
-        sys.exit(1)
+        return(None)
+    routes = prepare_routes(routes)
 
     rules = load_yml(f"{arguments[CONFDIRARG]}rules.yml")
     if rules == False:
-        sys.exit(1)
+        return(None)
 
-    rules, templates = prepare_rules(rules, routes, arguments)
-    if False in (rules, templates):
-        sys.exit(1)
+    rules, templates, index = prepare_rules(rules, routes, arguments, cache)
+    if False in (rules, templates, index):
+        return(None)
+
+    sources = {}
+    if os.path.isfile(f"{arguments[CONFDIRARG]}sources.yml"):
+        loaded = load_yml(f"{arguments[CONFDIRARG]}sources.yml")
+        if loaded == False:
+            return(None)
+        if check_sources(loaded or {}) == False:
+            return(None)
+        for name, source in prepare_sources(loaded or {}).items():
+            partition = load_source(name, source, routes, arguments, cache)
+            if partition is None:
+                return(None)
+            sources.update({name: partition})
+
+    if arguments[WHENCACHEARG] and cache['used'] != cache['parsed']:
+        save_when_cache(arguments[CONFDIRARG] + arguments[WHENCACHEARG],
+                        cache['used'])
+    cache['parsed'] = cache['used']
+
+    return({'routes': routes,
+            'source': None,
+            'rules': rules,
+            'templates': templates,
+            'index': index,
+            'prefilter': headers_prefilter(rules),
+            'batches': {},
+            'sources': sources})
+
+def bind_sources(app_config):
+# source snapshot is its partition over app_config, so it sees app_config
+# runtime state and its own rules and arguments
+    app_config.update({'sources': {
+        name: collections.ChainMap(partition, app_config)
+        for name, partition in app_config['sources'].items()}})
+
+def run_app(app_config):
+# runtime state is created here, so every forked worker gets its own
+    arguments = app_config['arguments']
+    app = web.Application(client_max_size=arguments[MAXBODYARG])
+    bind_sources(app_config)
+    app.add_routes([web.post('/', receive_handler),
+                    web.post('/hooks/{source}', receive_handler),
+                    web.get('/metrics', metrics_handler),
+                    web.post('/-/reload', reload_handler),
+                    web.get('/-/profile', profile_handler),
+                    web.post('/-/explain', explain_handler)])
+    app_config.update({
+                  'route_state': {},
+                  'source_state': {},
+                  'queue': None,
+                  'dedup': None,
+                  'budget': None,
+                  'profiler': None,
+                  'capture': None,
+                  'batch_tasks': set(),
+                  'background_tasks': set(),
+                  'open_batches': {},
+                  'scheduler': None,
+                  'tasks': []})
+    app_config['metrics'] = prepare_metrics(app_config)
+    if arguments[PROFILESAMPLEARG]:
+        app_config['profiler'] = RuleProfiler(arguments[PROFILETOPARG])
+# app_config is kept in holder dict to be swapped on reload of started app
+    app['config'] = {'app_config': app_config}
+    app.on_startup.append(start_dispatch)
+    app.on_startup.append(start_routes)
+    app.on_startup.append(start_retries)
+    app.on_startup.append(start_metrics)
+    app.on_startup.append(start_reload)
+    app.on_startup.append(start_capture)
+    app.on_cleanup.append(stop_dispatch)
+    app.on_cleanup.append(stop_capture)
+    app.on_cleanup.append(stop_routes)
+    app.on_cleanup.append(stop_retries)
+# request bodies are decompressed by read_body with size limit
+    web.run_app(app, port=arguments[PORTARG],
+                auto_decompress=False,
+                reuse_port=app_config['worker'] is not None,
+                loop=new_event_loop(arguments[LOOPARG]))
+
+def new_event_loop(name):
+# uvloop is optional, asyncio loop is used without it
+    if name == 'uvloop':
+        if uvloop is not None:
+            return(uvloop.new_event_loop())
+        logging.warning(
+            'new_event_loop: uvloop is not installed, asyncio loop is used')
+    return(asyncio.new_event_loop())
+
+def start_logging(arguments):
+    setup_logging(arguments[VERBOSEARG], arguments[LOGRATEARG],
+                  arguments[LOGBURSTARG], arguments[LOGTRUNCATEARG],
+                  arguments[LOGQUEUEARG])
+
+def run_workers(app_config, workers):
+# forks workers listening the same port with SO_REUSEPORT and restarts
+# them when they die. Prepared rules and templates are shared by fork.
+    metrics_dir = tempfile.mkdtemp(prefix='webrehook-')
+    children = {}
+    stopping = False
+
+    def spawn(worker):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+            code = 0
+            start_logging(app_config['arguments'])
+            try:
+                app_config.update({'worker': worker,
+                                   'metrics_dir': metrics_dir})
+                run_app(app_config)
+            except:
+                logging.exception(f'run_workers: Worker {worker} failed')
+                code = 1
+            finally:
+                stop_logging()
+                os._exit(code)
+        children.update({pid: worker})
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in children.keys():
+            os.kill(pid, signal.SIGTERM)
+
+    def reload(signum, frame):
+# supervisor reloads too, so restarted workers fork with current config
+        config = load_config(app_config['arguments'], app_config['cache'])
+        if config is None:
+            logging.error('run_workers: Config is not reloaded.')
+        else:
+            app_config.update(config)
+        for pid in list(children.keys()):
+            os.kill(pid, signal.SIGHUP)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGHUP, reload)
+    for worker in range(workers):
+        spawn(worker)
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        worker = children.pop(pid, None)
+        if worker is None or stopping:
+            continue
+        logging.warning(f'run_workers: Worker {worker} exited with ' +
+                        f'{status}. Restarting.')
+        time.sleep(RESTARTDELAY)
+        spawn(worker)
 
-    app = web.Application()
-    app.add_routes([web.post('/', receive_handler)])
-    app_config = {'routes': routes,
-                  'rules': rules,
-                  'templates': templates,
-                  'arguments': arguments}
-    app['app_config'] = app_config
-    web.run_app(app, port=arguments[PORTARG])
+    shutil.rmtree(metrics_dir, ignore_errors=True)
 
 if __name__ == '__main__':
     try:
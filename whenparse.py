@@ -3,7 +3,9 @@
 from sly import Lexer, Parser
 from sly.yacc import GrammarError
 from sly.lex import LexError
+import ast
 import logging
+import operator
 
 class WhenLexer(Lexer):
     tokens = { NAME, STRING, JSON, NUMBER, BINOP, BINOPEXC, NOT, IN, RESWORD }
@@ -123,6 +125,187 @@ class WhenParser(Parser):
     def expr(self, p):
         return p.NAME
 
+def json_path(node):
+# returns path tuple if node is json_query_recursive(JSON, [...]) call
+    if not isinstance(node, ast.Call) or \
+            not isinstance(node.func, ast.Name) or \
+            node.func.id != 'json_query_recursive' or \
+            len(node.args) != 2 or not isinstance(node.args[1], ast.List):
+        return(None)
+    path = []
+    for item in node.args[1].elts:
+        if not isinstance(item, ast.Constant):
+            return(None)
+        path.append(item.value)
+    return(tuple(path))
+
+def equality_predicates(source):
+# returns [(path, literal), ...] for JSON[...] == literal tests which must
+# all be true for the whole parsed expression to be true
+    try:
+        tree = ast.parse(source, mode='eval')
+    except SyntaxError:
+        return([])
+
+    predicates = []
+    nodes = [tree.body]
+    while nodes:
+        node = nodes.pop(0)
+        if isinstance(node, ast.BoolOp) and isinstance(node.op, ast.And):
+            nodes.extend(node.values)
+            continue
+        if not isinstance(node, ast.Compare) or len(node.ops) != 1 or \
+                not isinstance(node.ops[0], ast.Eq):
+            continue
+        left, right = node.left, node.comparators[0]
+        if isinstance(left, ast.Constant):
+            left, right = right, left
+        path = json_path(left)
+        if path and isinstance(right, ast.Constant):
+            predicates.append((path, right.value))
+    return(predicates)
+
+# closure backend: parsed when source is python expression, so its python
+# ast is compiled to tree of closures with the same precedence eval has.
+# Every closure takes JSON and per event memo dict, where values of already
+# walked JSON paths are kept and shared between all rules.
+COMPAREOPS = {
+    ast.Eq: operator.eq,
+    ast.NotEq: operator.ne,
+    ast.Lt: operator.lt,
+    ast.LtE: operator.le,
+    ast.Gt: operator.gt,
+    ast.GtE: operator.ge,
+    ast.Is: operator.is_,
+    ast.IsNot: operator.is_not,
+    ast.In: lambda a, b: a in b,
+    ast.NotIn: lambda a, b: a not in b,
+    }
+BINOPS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    }
+
+def path_accessor(path, accessors):
+    accessor = accessors.get(path)
+    if accessor is not None:
+        return(accessor)
+
+    parent = None
+    if len(path) > 1:
+        parent = path_accessor(path[:-1], accessors)
+    item = path[-1]
+    is_key = isinstance(item, str)
+    is_index = isinstance(item, int)
+
+    def accessor(JSON, memo):
+        value = memo.get(path, memo)
+        if value is not memo:
+            return(value)
+        obj = JSON if parent is None else parent(JSON, memo)
+        if is_key and isinstance(obj, dict):
+            value = obj.get(item)
+        elif is_index and isinstance(obj, list) and item < len(obj):
+            try:
+                value = obj[item]
+            except IndexError:
+                value = None
+        else:
+            value = None
+        memo[path] = value
+        return(value)
+
+    accessors.update({path: accessor})
+    return(accessor)
+
+def compile_node(node, accessors, names):
+    if isinstance(node, ast.Constant):
+        value = node.value
+        return(lambda JSON, memo: value)
+
+    if isinstance(node, ast.Name):
+        if node.id == 'JSON':
+            return(lambda JSON, memo: JSON)
+        if node.id in names:
+            value = names[node.id]
+            return(lambda JSON, memo: value)
+        name = node.id
+        def undefined(JSON, memo):
+            raise NameError(f'name {name!r} is not defined')
+        return(undefined)
+
+    if isinstance(node, ast.Call):
+        path = json_path(node)
+        if path:
+            return(path_accessor(path, accessors))
+        func = compile_node(node.func, accessors, names)
+        args = [compile_node(arg, accessors, names) for arg in node.args]
+        return(lambda JSON, memo: func(JSON, memo)(
+            *[arg(JSON, memo) for arg in args]))
+
+    if isinstance(node, ast.List):
+        items = [compile_node(item, accessors, names) for item in node.elts]
+        return(lambda JSON, memo: [item(JSON, memo) for item in items])
+
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+        operand = compile_node(node.operand, accessors, names)
+        return(lambda JSON, memo: not operand(JSON, memo))
+
+    if isinstance(node, ast.BinOp) and type(node.op) in BINOPS:
+        op = BINOPS[type(node.op)]
+        left = compile_node(node.left, accessors, names)
+        right = compile_node(node.right, accessors, names)
+        return(lambda JSON, memo: op(left(JSON, memo), right(JSON, memo)))
+
+    if isinstance(node, ast.BoolOp):
+        values = [compile_node(value, accessors, names)
+                  for value in node.values]
+        if isinstance(node.op, ast.And):
+            def bool_op(JSON, memo):
+                for value in values:
+                    result = value(JSON, memo)
+                    if not result:
+                        return(result)
+                return(result)
+        else:
+            def bool_op(JSON, memo):
+                for value in values:
+                    result = value(JSON, memo)
+                    if result:
+                        return(result)
+                return(result)
+        return(bool_op)
+
+    if isinstance(node, ast.Compare):
+        first = compile_node(node.left, accessors, names)
+        ops = [COMPAREOPS[type(op)] for op in node.ops]
+        comparators = [compile_node(comparator, accessors, names)
+                       for comparator in node.comparators]
+        if len(ops) == 1:
+            op, second = ops[0], comparators[0]
+            return(lambda JSON, memo: op(first(JSON, memo),
+                                         second(JSON, memo)))
+        pairs = list(zip(ops, comparators))
+        def compare(JSON, memo):
+            left = first(JSON, memo)
+            for op, comparator in pairs:
+                right = comparator(JSON, memo)
+                result = op(left, right)
+                if not result:
+                    return(result)
+                left = right
+            return(result)
+        return(compare)
+
+    raise SyntaxError(f'Unsupported expression {ast.dump(node)}')
+
+def compile_closure(source, accessors, names):
+# accessors is dict of path accessors to share between compiled expressions
+    tree = ast.parse(source, mode='eval')
+    return(compile_node(tree.body, accessors, names))
+
 def main(txt):
     lexer = WhenLexer()
     try:
@@ -132,8 +315,7 @@ def main(txt):
             f'parse_when: Unable to lex {txt}. Exiting.')
         return(None)
     except:
-        logging.error(
-            'parse_when: Lex unexpected error:', sys.exc_info()[0])
+        logging.exception('parse_when: Lex unexpected error')
         return(None)
 
 # Very weird these 2 lines below break parser when active
@@ -148,8 +330,7 @@ def main(txt):
             f'parse_when: Unable to parse {txt}. Exiting.')
         return(None)
     except:
-        logging.error(
-            'parse_when: Parse unexpected error:', sys.exc_info()[0])
+        logging.exception('parse_when: Parse unexpected error')
         return(None)
     return(result)
 